@@ -1,17 +1,24 @@
 import sys
-from notebook import Notebook, Note
+from notebook import Notebook, Note, NoteStorage
 
 class Menu:
     '''Display a menu and respond to choices when run.'''
 
-    def __init__(self):
-        self.notebook = Notebook()
+    def __init__(self, storage_path=None):
+        '''
+        Create the menu for a new notebook, or for the notebook stored at the
+        given path if one is given.
+        '''
+        storage = NoteStorage(storage_path) if storage_path else None
+        self.notebook = Notebook(indexed=True, storage=storage)
         self.choices = {
             "1": self.show_notes,
             "2": self.search_notes,
-            "3": self.add_note,
-            "4": self.modify_note,
-            "5": self.quit
+            "3": self.search_tags,
+            "4": self.add_note,
+            "5": self.modify_note,
+            "6": self.delete_note,
+            "7": self.quit
         }
 
     def display_menu(self):
@@ -20,9 +27,11 @@ class Menu:
 
         1. Show all Notes
         2. Search Notes
-        3. Add Note
-        4. Modify Note,
-        5. Quit
+        3. Search Tags
+        4. Add Note
+        5. Modify Note,
+        6. Delete Note
+        7. Quit
         """)
 
     def run(self):
@@ -47,6 +56,15 @@ class Menu:
         notes = self.notebook.search(filter)
         self.show_notes(notes)
 
+    def search_tags(self):
+        expression = input("Tags (e.g. work and not done): ")
+        try:
+            notes = self.notebook.find_tagged(expression)
+        except ValueError as e:
+            print(e)
+        else:
+            self.show_notes(notes)
+
     def add_note(self):
         memo = input("Enter a memo: ")
         self.notebook.new_note(memo)
@@ -61,9 +79,18 @@ class Menu:
         if tags:
             self.notebook.modify_tags(id, tags)
 
+    def delete_note(self):
+        id = input("Enter a note id: ")
+        if self.notebook.delete_note(id):
+            print("The note has been deleted.")
+        else:
+            print("{0} is not a valid note id".format(id))
+
     def quit(self):
         print("Thank you for using your notebook today.")
+        if self.notebook.storage is not None:
+            self.notebook.storage.close()
         sys.exit(0)
 
 if __name__ == "__main__":
-    Menu().run()
\ No newline at end of file
+    Menu(*sys.argv[1:2]).run()
\ No newline at end of file
@@ -1,7 +1,28 @@
 import datetime
+import itertools
+import json
+import math
+import os
+import re
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 
-# Store the next available id for all new notes
-last_id = 0
+# Allocates the ids of new notes. Taking the next value from an
+# itertools.count is a single atomic operation, so notes created in different
+# threads always get different ids without taking a lock.
+_note_ids = itertools.count(1)
+
+def _skip_ids(used_id):
+    '''
+    Advance the id allocator past an id that is already in use, e.g. the
+    last id in a NoteStorage.
+    '''
+    while next(_note_ids) < used_id:
+        pass
 
 class Note:
     '''
@@ -9,6 +30,9 @@ class Note:
     store tags for each note.
     '''
 
+    # Notes are created in large numbers, so they do not carry a __dict__.
+    __slots__ = ('memo', 'tags', 'creation_date', 'id')
+
     def __init__(self, memo, tags=''):
         '''
         Initialise a note with memo and optional space-separated tags.
@@ -17,9 +41,7 @@ class Note:
         self.memo = memo
         self.tags = tags
         self.creation_date = datetime.date.today()
-        global last_id
-        last_id += 1
-        self.id = last_id
+        self.id = next(_note_ids)
 
     def match(self, filter):
         '''
@@ -32,48 +54,999 @@ class Note:
         '''
         return filter in self.memo or filter in self.tags
 
+class StoredNote(Note):
+    '''
+    A note kept in a NoteStorage. The memo is not held in memory; it is read
+    from the storage files each time it is accessed. Changing the memo or tags
+    appends the change to the storage log.
+    '''
+
+    __slots__ = ('_tags', '_storage', '_location')
+
+    def __init__(self, storage, note_id, creation_date, tags, location):
+        '''
+        Initialise a note that already exists in the storage. Unlike
+        Note.__init__ this does not allocate a new id.
+        :param location: (file, offset, length) of the memo in the storage.
+        '''
+        self.id = note_id
+        self.creation_date = creation_date
+        self._tags = tags
+        self._storage = storage
+        self._location = location
+
+    @property
+    def memo(self):
+        return self._storage.read_memo(self)
+
+    @memo.setter
+    def memo(self, memo):
+        self._storage.write_memo(self.id, memo)
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._storage.write_tags(self.id, tags)
+
+class NoteView(Note):
+    '''
+    Lightweight view of a note held in a NoteColumns store. It has the same
+    attributes as a Note, which are read from and written to the store.
+    '''
+
+    __slots__ = ('_store',)
+
+    def __init__(self, store, note_id):
+        '''Initialise a view of the note with the given id in the store.'''
+        self._store = store
+        self.id = note_id
+
+    @property
+    def memo(self):
+        return self._store.read_memo(self.id)
+
+    @memo.setter
+    def memo(self, memo):
+        self._store.write_memo(self.id, memo)
+
+    @property
+    def tags(self):
+        return self._store.read_tags(self.id)
+
+    @tags.setter
+    def tags(self, tags):
+        self._store.write_tags(self.id, tags)
+
+    @property
+    def creation_date(self):
+        return self._store.read_creation_date(self.id)
+
+class _Columns:
+    '''The arrays and text buffer holding the notes of a NoteColumns.'''
+
+    __slots__ = ('ids', 'dates', 'memos', 'tag_ids', 'text', 'tags',
+                 'tag_index')
+
+    # Size of the text buffer that memo offsets and lengths must stay below
+    # to fit in 32 bits each.
+    max_text = 1 << 32
+
+    def __init__(self):
+        self.ids = array('q')
+        # Date ordinal of each note, or 0 for a deleted note.
+        self.dates = array('i')
+        # Offset of each memo in the text buffer shifted left by 32 bits,
+        # plus its length, so that both are replaced by a single store. This
+        # limits the buffer to max_text bytes.
+        self.memos = array('Q')
+        self.tag_ids = array('I')
+        self.text = bytearray()
+        # Interned tags strings, and tags string -> tags id
+        self.tags = []
+        self.tag_index = {}
+
+    def row(self, note_id):
+        '''Return the row of the note with the given id.'''
+        row = bisect_left(self.ids, note_id)
+        if row == len(self.ids) or self.ids[row] != note_id or \
+                not self.dates[row]:
+            raise KeyError(note_id)
+        return row
+
+    def add_text(self, text):
+        '''
+        Append text to the buffer and return its packed memo entry.
+        :raise: OverflowError if the buffer would grow past max_text bytes,
+        in which case nothing is appended.
+        '''
+        data = text.encode('utf8')
+        offset = len(self.text)
+        if offset + len(data) >= self.max_text:
+            raise OverflowError(
+                "The memos of a NoteColumns store cannot take up more than "
+                "{} bytes".format(self.max_text - 1))
+        self.text += data
+        return offset << 32 | len(data)
+
+    def memo(self, row):
+        '''Return the offset and length of the memo in a row.'''
+        memo = self.memos[row]
+        return memo >> 32, memo & 0xFFFFFFFF
+
+    def tag_id(self, tags):
+        '''Return the id of a tags string, interning it if it is new.'''
+        tag_id = self.tag_index.get(tags)
+        if tag_id is None:
+            tag_id = self.tag_index[tags] = len(self.tags)
+            self.tags.append(tags)
+        return tag_id
+
+class NoteColumns:
+    '''
+    Compact, columnar store of notes, used by a Notebook in place of a
+    dictionary of Note objects. Each note is a row in a set of arrays: its id,
+    creation date, the position of its memo in one shared text buffer and the
+    id of its tags string, each distinct tags string being stored only once.
+    Notes are read through NoteView objects, which are created on demand.
+
+    Notes must be added in increasing id order, which keeps the id column
+    sorted so a note is found by binary search instead of through a
+    dictionary.
+
+    Compaction builds new columns and swaps them in with a single assignment,
+    so a view being read at the same time sees either the old or the new
+    columns, never a mixture. A memo's position is likewise replaced with a
+    single store, so it is never read with the offset of one memo and the
+    length of another.
+    '''
+
+    def __init__(self):
+        '''Initialise an empty store.'''
+        self._columns = _Columns()
+        self._count = 0
+        # Number of bytes of text and rows no longer used by any note
+        self._garbage = 0
+        self._deleted = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, note_id):
+        try:
+            self._columns.row(note_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        columns = self._columns
+        return (columns.ids[row] for row in range(len(columns.ids))
+                if columns.dates[row])
+
+    def __getitem__(self, note_id):
+        self._columns.row(note_id)
+        return NoteView(self, note_id)
+
+    def get(self, note_id, default=None):
+        '''Return a view of the note with the given id, or the default.'''
+        return NoteView(self, note_id) if note_id in self else default
+
+    def values(self):
+        '''Return views of all the notes in the order they were added.'''
+        return [NoteView(self, note_id) for note_id in self]
+
+    def __setitem__(self, note_id, note):
+        '''Copy a new note into the store.'''
+        columns = self._columns
+        if columns.ids and note_id <= columns.ids[-1]:
+            raise ValueError("Notes must be added in increasing id order")
+        columns.memos.append(columns.add_text(note.memo))
+        columns.tag_ids.append(columns.tag_id(note.tags))
+        columns.dates.append(note.creation_date.toordinal())
+        # The id is appended last so the row is complete once it can be found.
+        columns.ids.append(note_id)
+        self._count += 1
+
+    def __delitem__(self, note_id):
+        '''
+        Remove a note. Its row and memo stay in the store as garbage until it
+        is compacted.
+        '''
+        columns = self._columns
+        row = columns.row(note_id)
+        columns.dates[row] = 0
+        self._garbage += columns.memo(row)[1]
+        self._deleted += 1
+        self._count -= 1
+        self._check_compaction()
+
+    def read_memo(self, note_id):
+        columns = self._columns
+        offset, length = columns.memo(columns.row(note_id))
+        return columns.text[offset:offset + length].decode('utf8')
+
+    def write_memo(self, note_id, memo):
+        columns = self._columns
+        row = columns.row(note_id)
+        old_length = columns.memo(row)[1]
+        # One store, so a reader sees either the old memo or the new one.
+        columns.memos[row] = columns.add_text(memo)
+        self._garbage += old_length
+        self._check_compaction()
+
+    def read_tags(self, note_id):
+        columns = self._columns
+        return columns.tags[columns.tag_ids[columns.row(note_id)]]
+
+    def write_tags(self, note_id, tags):
+        columns = self._columns
+        columns.tag_ids[columns.row(note_id)] = columns.tag_id(tags)
+
+    def read_creation_date(self, note_id):
+        columns = self._columns
+        return datetime.date.fromordinal(columns.dates[columns.row(note_id)])
+
+    def _check_compaction(self):
+        '''Compact the store once half of its text or rows are garbage.'''
+        columns = self._columns
+        if self._garbage > max(len(columns.text) // 2, 1 << 16) or \
+                self._deleted > max(len(columns.ids) // 2, 1024):
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrite the store without the deleted notes, replaced memos and
+        unused tags strings.
+        '''
+        old = self._columns
+        new = _Columns()
+        for row in range(len(old.ids)):
+            if not old.dates[row]:
+                continue
+            new.ids.append(old.ids[row])
+            new.dates.append(old.dates[row])
+            offset, length = old.memo(row)
+            new.memos.append(len(new.text) << 32 | length)
+            new.text += old.text[offset:offset + length]
+            new.tag_ids.append(new.tag_id(old.tags[old.tag_ids[row]]))
+        self._columns = new
+        self._garbage = 0
+        self._deleted = 0
+
+class NoteStorage:
+    '''
+    Persistent storage for the notes of a notebook, made of two files:
+
+    <path>.log       append-only log of the changes since the last snapshot.
+                     Each record is a JSON header line, followed by the memo
+                     bytes for records that set a memo.
+    <path>.snapshot  compacted copy of all the notes: the memos one after the
+                     other, then a JSON index of every note's id, date, tags
+                     and memo position, then a trailer giving the position of
+                     the index.
+
+    Opening the storage reads the snapshot index and replays the log without
+    reading any memos. Changes are appended to the log, and once the log has
+    grown larger than the snapshot it is compacted into a new snapshot.
+
+    The storage files are only accessed while holding a lock, so memos can be
+    read from several threads while changes are being written.
+    '''
+
+    _trailer = struct.Struct('<Q8s')
+    _magic = b'NOTESNAP'
+
+    def __init__(self, path, sync=True, min_compaction=1 << 20):
+        '''
+        Open the storage at the given path, creating it if necessary.
+        :param path: path of the storage files, without the file extensions.
+        :param sync: fsync every change to make it durable before returning.
+        :param min_compaction: minimum size in bytes of the log to compact.
+        '''
+        self.log_path = path + '.log'
+        self.snapshot_path = path + '.snapshot'
+        self.sync = sync
+        self.min_compaction = min_compaction
+        self._lock = threading.RLock()
+        # note id -> StoredNote, in creation order
+        self.notes = {}
+        self.last_id = 0
+        self._snapshot = None
+        self._snapshot_size = 0
+        self._load_snapshot()
+        self._replay_log()
+        self._log = open(self.log_path, 'ab')
+        # Memos are read through unbuffered files, so that a read never sees
+        # stale buffered data after the log has been emptied by compact().
+        self._log_reader = open(self.log_path, 'rb', buffering=0)
+
+    def _load_snapshot(self):
+        '''Read the index of the snapshot, if there is one.'''
+        try:
+            self._snapshot = open(self.snapshot_path, 'rb', buffering=0)
+        except FileNotFoundError:
+            return
+        self._snapshot_size = self._snapshot.seek(0, os.SEEK_END)
+        self._snapshot.seek(-self._trailer.size, os.SEEK_END)
+        index_offset, magic = self._trailer.unpack(
+            self._snapshot.read(self._trailer.size))
+        if magic != self._magic:
+            raise ValueError("{} is not a notebook snapshot".format(
+                self.snapshot_path))
+        self._snapshot.seek(index_offset)
+        index = json.loads(self._snapshot.read(
+            self._snapshot_size - self._trailer.size - index_offset))
+        self.last_id = index['last_id']
+        for note_id, date, tags, offset, length in index['notes']:
+            self.notes[note_id] = StoredNote(
+                self, note_id, datetime.date.fromordinal(date), tags,
+                ('snapshot', offset, length))
+
+    def _replay_log(self):
+        '''
+        Apply the changes in the log to the notes loaded from the snapshot. A
+        record left incomplete by a crash is truncated from the log.
+        '''
+        with open(self.log_path, 'a+b') as log:
+            size = log.seek(0, os.SEEK_END)
+            log.seek(0)
+            good = 0
+            while True:
+                line = log.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                offset = log.tell()
+                length = record.get('length', 0)
+                if offset + length > size:
+                    break
+                log.seek(length, os.SEEK_CUR)
+                good = log.tell()
+                self._apply(record, ('log', offset, length))
+            if good < size:
+                log.truncate(good)
+
+    def _apply(self, record, location):
+        '''Apply a log record to the notes in memory.'''
+        note_id = record['id']
+        op = record['op']
+        if op == 'new':
+            self.notes[note_id] = StoredNote(
+                self, note_id, datetime.date.fromordinal(record['date']),
+                record['tags'], location)
+            self.last_id = max(self.last_id, note_id)
+        elif op == 'memo':
+            self.notes[note_id]._location = location
+        elif op == 'tags':
+            self.notes[note_id]._tags = record['tags']
+        elif op == 'delete':
+            self.notes.pop(note_id, None)
+
+    def _append(self, record, memo=None):
+        '''
+        Append a record, and optionally a memo, to the log. The caller must
+        hold the lock.
+        :return: location of the memo in the log.
+        '''
+        data = memo.encode('utf8') if memo is not None else b''
+        if memo is not None:
+            record['length'] = len(data)
+        header = json.dumps(record).encode('utf8') + b'\n'
+        offset = self._log.seek(0, os.SEEK_END) + len(header)
+        self._log.write(header + data)
+        self._log.flush()
+        if self.sync:
+            os.fsync(self._log.fileno())
+        return 'log', offset, len(data)
+
+    def add(self, note):
+        '''
+        Store a new note.
+        :return: StoredNote to use in place of the given note.
+        '''
+        with self._lock:
+            location = self._append({'op': 'new', 'id': note.id,
+                                     'date': note.creation_date.toordinal(),
+                                     'tags': note.tags}, note.memo)
+            stored = StoredNote(self, note.id, note.creation_date, note.tags,
+                                location)
+            self.notes[note.id] = stored
+            self.last_id = max(self.last_id, note.id)
+            self._check_compaction()
+        return stored
+
+    def write_memo(self, note_id, memo):
+        '''Store a new memo for a note.'''
+        with self._lock:
+            location = self._append({'op': 'memo', 'id': note_id}, memo)
+            self.notes[note_id]._location = location
+            self._check_compaction()
+
+    def write_tags(self, note_id, tags):
+        '''Store new tags for a note.'''
+        with self._lock:
+            self._append({'op': 'tags', 'id': note_id, 'tags': tags})
+            self.notes[note_id]._tags = tags
+            self._check_compaction()
+
+    def delete(self, note_id):
+        '''Delete a note from the storage.'''
+        with self._lock:
+            self._append({'op': 'delete', 'id': note_id})
+            self.notes.pop(note_id, None)
+            self._check_compaction()
+
+    def read_memo(self, note):
+        '''Read the memo of a StoredNote from the storage files.'''
+        with self._lock:
+            source, offset, length = note._location
+            file = self._snapshot if source == 'snapshot' else \
+                self._log_reader
+            file.seek(offset)
+            return file.read(length).decode('utf8')
+
+    def _check_compaction(self):
+        '''Compact the log once it is larger than the snapshot.'''
+        if self._log.tell() >= max(self.min_compaction, self._snapshot_size):
+            self.compact()
+
+    def compact(self):
+        '''
+        Write all the notes to a new snapshot and empty the log. The new
+        snapshot replaces the old one atomically, and replaying a log that was
+        not emptied because of a crash leaves the notes unchanged.
+        '''
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        temp_path = self.snapshot_path + '.tmp'
+        index = []
+        locations = {}
+        with open(temp_path, 'wb') as snapshot:
+            for note in self.notes.values():
+                data = note.memo.encode('utf8')
+                offset = snapshot.tell()
+                snapshot.write(data)
+                index.append((note.id, note.creation_date.toordinal(),
+                              note.tags, offset, len(data)))
+                locations[note.id] = ('snapshot', offset, len(data))
+            index_offset = snapshot.tell()
+            snapshot.write(json.dumps({'last_id': self.last_id,
+                                       'notes': index}).encode('utf8'))
+            snapshot.write(self._trailer.pack(index_offset, self._magic))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        if self._snapshot is not None:
+            self._snapshot.close()
+        os.replace(temp_path, self.snapshot_path)
+        self._snapshot = open(self.snapshot_path, 'rb', buffering=0)
+        self._snapshot_size = self._snapshot.seek(0, os.SEEK_END)
+        for note_id, location in locations.items():
+            self.notes[note_id]._location = location
+        self._log.truncate(0)
+        self._log.seek(0)
+        if self.sync:
+            os.fsync(self._log.fileno())
+
+    def close(self):
+        '''Close the storage files.'''
+        with self._lock:
+            for file in (self._log, self._log_reader, self._snapshot):
+                if file is not None:
+                    file.close()
+
+class SearchIndex:
+    '''
+    Inverted index over the memos and tags of notes. N-gram postings narrow a
+    substring search down to the candidate notes containing every n-gram of
+    the filter, and token postings rank notes for multi-word queries.
+
+    Only the postings are kept, so a note must be removed from the index
+    before its memo or tags change, while the postings to remove can still be
+    worked out from them.
+    '''
+
+    def __init__(self, ngram_length=3):
+        '''Initialise an empty index using n-grams of the given length.'''
+        self.ngram_length = ngram_length
+        # n-gram -> set of ids of the notes containing it
+        self.ngram_postings = defaultdict(set)
+        # lower case word -> {note id: number of occurrences}
+        self.token_postings = defaultdict(dict)
+        # Number of notes in the index
+        self.note_count = 0
+
+    def _ngrams(self, text):
+        '''Return the set of n-grams in the text.'''
+        n = self.ngram_length
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    @staticmethod
+    def tokenise(text):
+        '''Split text into lower case words.'''
+        return re.findall(r'\w+', text.lower())
+
+    def _terms(self, memo, tags):
+        '''Return the n-grams and the word counts of a memo and tags.'''
+        return (self._ngrams(memo) | self._ngrams(tags),
+                Counter(self.tokenise(memo) + self.tokenise(tags)))
+
+    def add(self, note):
+        '''Add the memo and tags of a note to the index.'''
+        ngrams, tokens = self._terms(note.memo, note.tags)
+        for ngram in ngrams:
+            self.ngram_postings[ngram].add(note.id)
+        for token, count in tokens.items():
+            self.token_postings[token][note.id] = count
+        self.note_count += 1
+
+    def remove(self, note):
+        '''
+        Remove a note from the index. The memo and tags of the note must not
+        have changed since it was added.
+        '''
+        ngrams, tokens = self._terms(note.memo, note.tags)
+        for ngram in ngrams:
+            postings = self.ngram_postings[ngram]
+            postings.discard(note.id)
+            if not postings:
+                del self.ngram_postings[ngram]
+        for token in tokens:
+            postings = self.token_postings[token]
+            del postings[note.id]
+            if not postings:
+                del self.token_postings[token]
+        self.note_count -= 1
+
+    def candidates(self, filter):
+        '''
+        Return the ids of the notes that may contain the filter text, or None
+        if the filter is shorter than an n-gram and every note is a candidate.
+        The candidates still have to be verified with Note.match().
+        '''
+        ngrams = self._ngrams(filter)
+        if not ngrams:
+            return None
+        # Intersect the smallest postings first to keep the sets small.
+        postings = sorted((self.ngram_postings.get(ngram, set())
+                           for ngram in ngrams), key=len)
+        return set.intersection(*postings)
+
+    def rank(self, query):
+        '''
+        Score the notes containing any word of the query with tf-idf.
+        :param query: words to search for, in any order and case.
+        :return: list of (score, note id) tuples, best match first.
+        '''
+        scores = defaultdict(float)
+        for token in set(self.tokenise(query)):
+            postings = self.token_postings.get(token)
+            if not postings:
+                continue
+            weight = math.log(1 + self.note_count / len(postings))
+            for note_id, count in postings.items():
+                scores[note_id] += count * weight
+        return sorted(((score, note_id) for note_id, score in scores.items()),
+                      key=lambda item: (-item[0], item[1]))
+
+# Positions of the bits set in each byte value, used by TagIndex.
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1)
+              for byte in range(256)]
+
+class TagIndex:
+    '''
+    Bitmap index from tags to the notes carrying them. Each note in the index
+    has a slot, a dense number counted by the index itself, and each tag is
+    interned as a tag id with a bitmap of the slots of its notes, so tag
+    expressions are evaluated with bitwise operations, "not" against the
+    bitmap of all the notes, and the slots are mapped back to note ids.
+
+    A bitmap is a dictionary of chunk number -> int holding chunk_bits bits,
+    with empty chunks left out, so changing a note only copies one small
+    chunk and a tag only uses memory for the chunks holding its notes. The
+    slots of deleted notes are reclaimed once they are half of the slots.
+    '''
+
+    # Number of slots in each chunk of a bitmap.
+    chunk_bits = 1024
+
+    def __init__(self):
+        '''Initialise an empty tag index.'''
+        # tag -> tag id, and the bitmap of each tag id
+        self.tag_ids = {}
+        self.bitmaps = []
+        # Bitmap of the slots of all the notes in the index
+        self.all_notes = {}
+        # Note id in each slot. Notes are added in increasing id order, so
+        # the slot of a note is found by binary search.
+        self.slot_ids = array('q')
+        self._count = 0
+
+    def _slot(self, note_id):
+        '''Return the slot of a note id, or None if it has none.'''
+        slot = bisect_left(self.slot_ids, note_id)
+        if slot == len(self.slot_ids) or self.slot_ids[slot] != note_id:
+            return None
+        return slot
+
+    def _tag_bitmap(self, tag):
+        '''Return the bitmap of a tag, interning the tag if it is new.'''
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_ids[tag] = len(self.bitmaps)
+            self.bitmaps.append({})
+        return self.bitmaps[tag_id]
+
+    def add(self, note):
+        '''Parse the space-separated tags of a note and index them.'''
+        slot = self._slot(note.id)
+        if slot is None:
+            if self.slot_ids and note.id < self.slot_ids[-1]:
+                raise ValueError("Notes must be added in increasing id order")
+            if len(self.slot_ids) >= max(2 * self._count, 1024):
+                self._compact()
+            slot = len(self.slot_ids)
+            self.slot_ids.append(note.id)
+        chunk, bit = divmod(slot, self.chunk_bits)
+        bit = 1 << bit
+        for tag in set(note.tags.split()):
+            bitmap = self._tag_bitmap(tag)
+            bitmap[chunk] = bitmap.get(chunk, 0) | bit
+        notes = self.all_notes.get(chunk, 0)
+        if not notes & bit:
+            self.all_notes[chunk] = notes | bit
+            self._count += 1
+
+    def remove(self, note):
+        '''
+        Remove a note from the index. The tags of the note must not have
+        changed since it was added.
+        '''
+        slot = self._slot(note.id)
+        if slot is None:
+            return
+        chunk, bit = divmod(slot, self.chunk_bits)
+        mask = ~(1 << bit)
+        for tag in set(note.tags.split()):
+            tag_id = self.tag_ids.get(tag)
+            if tag_id is not None:
+                self._clear(self.bitmaps[tag_id], chunk, mask)
+        if self._clear(self.all_notes, chunk, mask):
+            self._count -= 1
+
+    @staticmethod
+    def _clear(bitmap, chunk, mask):
+        '''
+        Clear a bit of a bitmap, dropping the chunk if it becomes empty.
+        :return: True if the bit was set.
+        '''
+        bits = bitmap.get(chunk, 0)
+        cleared = bits & mask
+        if cleared:
+            bitmap[chunk] = cleared
+        else:
+            bitmap.pop(chunk, None)
+        return cleared != bits
+
+    def _slots(self, bitmap):
+        '''Generate the slots set in a bitmap in ascending order.'''
+        size = self.chunk_bits // 8
+        for chunk in sorted(bitmap):
+            base = chunk * self.chunk_bits
+            # Look the bits up a byte at a time.
+            for offset, byte in enumerate(
+                    bitmap[chunk].to_bytes(size, 'little')):
+                if byte:
+                    for bit in _BYTE_BITS[byte]:
+                        yield base + 8 * offset + bit
+
+    def _bitmap(self, slots):
+        '''Build a bitmap with the given slots set.'''
+        bitmap = {}
+        for slot in slots:
+            chunk, bit = divmod(slot, self.chunk_bits)
+            bitmap[chunk] = bitmap.get(chunk, 0) | 1 << bit
+        return bitmap
+
+    def _compact(self):
+        '''
+        Give the notes in the index new slots without gaps, dropping the
+        slots of deleted notes and the tags no longer used.
+        '''
+        live = list(self._slots(self.all_notes))
+        new_slots = {slot: new_slot for new_slot, slot in enumerate(live)}
+        tag_ids = {}
+        bitmaps = []
+        for tag, tag_id in self.tag_ids.items():
+            bitmap = self.bitmaps[tag_id]
+            if bitmap:
+                tag_ids[tag] = len(bitmaps)
+                bitmaps.append(self._bitmap(
+                    new_slots[slot] for slot in self._slots(bitmap)))
+        self.tag_ids = tag_ids
+        self.bitmaps = bitmaps
+        self.all_notes = self._bitmap(range(len(live)))
+        self.slot_ids = array('q', (self.slot_ids[slot] for slot in live))
+
+    def bitmap(self, tag):
+        '''Return the bitmap of the notes with the given tag.'''
+        tag_id = self.tag_ids.get(tag)
+        return self.bitmaps[tag_id] if tag_id is not None else {}
+
+    def query(self, expression):
+        '''
+        Find the notes matching a tag expression, made of tags combined with
+        "and", "or", "not" and parentheses, e.g. "work and not (done or old)".
+        "not" binds tightest and "or" loosest.
+        :return: list of the matching note ids in ascending order.
+        :raise: ValueError if the expression is malformed.
+        '''
+        tokens = re.findall(r'[()]|[^\s()]+', expression)
+        bitmap, position = self._parse_or(tokens, 0)
+        if position != len(tokens):
+            raise ValueError("Unexpected {!r} in tag expression".format(
+                tokens[position]))
+        return [self.slot_ids[slot] for slot in self._slots(bitmap)]
+
+    def _parse_or(self, tokens, position):
+        bitmap, position = self._parse_and(tokens, position)
+        while position < len(tokens) and tokens[position] == 'or':
+            right, position = self._parse_and(tokens, position + 1)
+            bitmap = {chunk: bitmap.get(chunk, 0) | right.get(chunk, 0)
+                      for chunk in bitmap.keys() | right.keys()}
+        return bitmap, position
+
+    def _parse_and(self, tokens, position):
+        bitmap, position = self._parse_not(tokens, position)
+        while position < len(tokens) and tokens[position] == 'and':
+            right, position = self._parse_not(tokens, position + 1)
+            both = {}
+            for chunk in bitmap.keys() & right.keys():
+                bits = bitmap[chunk] & right[chunk]
+                if bits:
+                    both[chunk] = bits
+            bitmap = both
+        return bitmap, position
+
+    def _parse_not(self, tokens, position):
+        if position == len(tokens):
+            raise ValueError("Incomplete tag expression")
+        token = tokens[position]
+        if token == 'not':
+            bitmap, position = self._parse_not(tokens, position + 1)
+            others = {}
+            for chunk, notes in self.all_notes.items():
+                bits = notes & ~bitmap.get(chunk, 0)
+                if bits:
+                    others[chunk] = bits
+            return others, position
+        if token == '(':
+            bitmap, position = self._parse_or(tokens, position + 1)
+            if position == len(tokens) or tokens[position] != ')':
+                raise ValueError("Missing ) in tag expression")
+            return bitmap, position + 1
+        if token in (')', 'and', 'or'):
+            raise ValueError("Unexpected {!r} in tag expression".format(token))
+        return self.bitmap(token), position + 1
+
+class ReadWriteLock:
+    '''
+    Lock that can be held by many readers at once, or by a single writer.
+    Readers wait while a writer holds the lock or is waiting for it, so a
+    steady stream of readers cannot starve the writers. The lock is not
+    reentrant.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        '''Context manager holding the lock for reading.'''
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        '''Context manager holding the lock for writing.'''
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
 class Notebook:
     '''
     Represents a collection of notes that can be tagged, modified and searched.
+    A notebook can be shared between threads: searches run concurrently, while
+    changes are made one at a time.
     '''
 
-    def __init__(self):
-        '''Initialise a notebook with an empty list.'''
-        self.notes = []
+    def __init__(self, indexed=False, storage=None, compact=False):
+        '''
+        Initialise a notebook with an empty id to note index. If indexed is
+        True, also maintain a SearchIndex to speed up searches. If a
+        NoteStorage is given, the notebook is loaded from it and every change
+        is saved to it; its SearchIndex is only built on the first search, so
+        that opening it does not read every memo. If compact is True, the
+        notes are held in a NoteColumns store and returned as NoteView
+        objects.
+        '''
+        if compact and storage is not None:
+            raise ValueError("A compact notebook cannot use a NoteStorage")
+        self._notes_by_id = NoteColumns() if compact else {}
+        self.search_index = SearchIndex() if indexed and storage is None \
+            else None
+        self._search_index_pending = indexed and storage is not None
+        self.tag_index = TagIndex()
+        self.storage = storage
+        self._lock = ReadWriteLock()
+        if storage is not None:
+            # Continue the ids from the notes already stored.
+            _skip_ids(storage.last_id)
+            for note in storage.notes.values():
+                self._add_note(note)
+
+    @property
+    def notes(self):
+        '''List of all the notes in the order they were created.'''
+        with self._lock.read():
+            return list(self._notes_by_id.values())
 
     def new_note(self, memo, tags=''):
-        '''Create a new note and add it to the list.'''
-        self.notes.append(Note(memo, tags))
+        '''Create a new note and add it to the notebook.'''
+        with self._lock.write():
+            # The id is allocated under the lock so notes are added in id
+            # order.
+            note = Note(memo, tags)
+            if self.storage is not None:
+                note = self.storage.add(note)
+            self._add_note(note)
+            return self._notes_by_id[note.id]
+
+    def _add_note(self, note):
+        '''Add a note to the id to note index and the search indexes.'''
+        self._notes_by_id[note.id] = note
+        self.tag_index.add(note)
+        if self.search_index is not None:
+            self.search_index.add(note)
+
+    def _build_search_index(self):
+        '''Build the search index if it is still to be built.'''
+        if self._search_index_pending:
+            with self._lock.write():
+                if self._search_index_pending:
+                    search_index = SearchIndex()
+                    for note in self._notes_by_id.values():
+                        search_index.add(note)
+                    self.search_index = search_index
+                    self._search_index_pending = False
+
+    @staticmethod
+    def _normalise_id(note_id):
+        '''
+        Convert a note id given to the API, e.g. a string typed into the menu,
+        into the integer id of a note. Return None if it is not a valid id.
+        '''
+        try:
+            return int(note_id)
+        except (TypeError, ValueError):
+            return None
 
     def _find_note(self, note_id):
         '''Locate the note with the given id.'''
-        for note in self.notes:
-            if str(note.id) == str(note_id):
-                return note
-        return None
+        return self._notes_by_id.get(self._normalise_id(note_id))
 
     def modify_memo(self, note_id, memo):
         '''
         Find the note with the given id and change its memo to the given value.
         '''
-        note = self._find_note(note_id)
-        if note:
-            note.memo = memo
-            return True
-        return False
+        with self._lock.write():
+            note = self._find_note(note_id)
+            if note:
+                if self.search_index is not None:
+                    self.search_index.remove(note)
+                note.memo = memo
+                if self.search_index is not None:
+                    self.search_index.add(note)
+                return True
+            return False
 
     def modify_tags(self, note_id, tags):
         '''
         Find the note with the given id and change its tags to the given value.
         '''
-        for note in self.notes:
-            if note.id == note_id:
+        with self._lock.write():
+            note = self._find_note(note_id)
+            if note:
+                self.tag_index.remove(note)
+                if self.search_index is not None:
+                    self.search_index.remove(note)
                 note.tags = tags
-                break
+                self.tag_index.add(note)
+                if self.search_index is not None:
+                    self.search_index.add(note)
+                return True
+            return False
+
+    def delete_note(self, note_id):
+        '''Find the note with the given id and remove it from the notebook.'''
+        with self._lock.write():
+            note = self._find_note(note_id)
+            if note is None:
+                return False
+            note_id = note.id
+            self.tag_index.remove(note)
+            if self.search_index is not None:
+                self.search_index.remove(note)
+            del self._notes_by_id[note_id]
+            if self.storage is not None:
+                self.storage.delete(note_id)
+            return True
 
     def search(self, filter):
         '''Find all notes that match the given filter string.'''
-        return [note for note in self.notes if note.match(filter)]
+        self._build_search_index()
+        with self._lock.read():
+            if self.search_index is not None:
+                note_ids = self.search_index.candidates(filter)
+                if note_ids is not None:
+                    # Ids are allocated in creation order.
+                    notes = (self._notes_by_id[i] for i in sorted(note_ids))
+                    return [note for note in notes if note.match(filter)]
+            return [note for note in self._notes_by_id.values()
+                    if note.match(filter)]
+
+    def find_tagged(self, expression):
+        '''
+        Find all notes whose tags match a tag expression such as
+        "work and (urgent or today) and not done". See TagIndex.query().
+        '''
+        with self._lock.read():
+            return [self._notes_by_id[note_id]
+                    for note_id in self.tag_index.query(expression)]
+
+    def ranked_search(self, query):
+        '''
+        Find the notes containing any of the words in the query, ordered from
+        the best to the worst match. Unlike search(), words are matched whole
+        and case insensitively.
+        '''
+        self._build_search_index()
+        with self._lock.read():
+            search_index = self.search_index
+            if search_index is None:
+                search_index = SearchIndex()
+                for note in self._notes_by_id.values():
+                    search_index.add(note)
+            return [self._notes_by_id[note_id]
+                    for score, note_id in search_index.rank(query)]
 
 # Sample code to demonstrate the Notebook and Note API
 def main():
@@ -0,0 +1,70 @@
+from notebook import Notebook, NoteStorage
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+Tests of reopening a NoteStorage whose log was left incomplete by a crash.
+"""
+
+
+class TestTornLogTail(unittest.TestCase):
+    def setUp(self):
+        """
+        Store a few notes and changes in a new storage, without compacting
+        it, so they are all in the log.
+        :return: None
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'notes')
+        storage = NoteStorage(self.path, sync=False)
+        notebook = Notebook(storage=storage)
+        first = notebook.new_note('first memo', 'a b')
+        notebook.new_note('second memo', 'b')
+        notebook.modify_memo(first.id, 'changed memo')
+        storage.close()
+        self.log_size = os.path.getsize(self.path + '.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        """Open the storage again and return its notes' memos and tags."""
+        storage = NoteStorage(self.path, sync=False)
+        self.addCleanup(storage.close)
+        notebook = Notebook(storage=storage)
+        return [(note.memo, note.tags) for note in notebook.notes]
+
+    def assert_torn_tail_dropped(self, tail):
+        """Append a torn record to the log and check it is ignored."""
+        with open(self.path + '.log', 'ab') as log:
+            log.write(tail)
+        self.assertEqual(self.reopen(),
+                         [('changed memo', 'a b'), ('second memo', 'b')])
+        self.assertEqual(os.path.getsize(self.path + '.log'), self.log_size)
+
+    def test_partial_header(self):
+        self.assert_torn_tail_dropped(b'{"op": "new", "id": 9')
+
+    def test_garbage_line(self):
+        self.assert_torn_tail_dropped(b'\x00\x00\x00\n')
+
+    def test_partial_memo(self):
+        header = json.dumps({'op': 'memo', 'id': 1, 'length': 100})
+        self.assert_torn_tail_dropped(header.encode('utf8') + b'\nshort')
+
+    def test_changes_after_reopening(self):
+        self.assert_torn_tail_dropped(b'{"op": "tags"')
+        storage = NoteStorage(self.path, sync=False)
+        notebook = Notebook(storage=storage)
+        notebook.new_note('third memo', 'c')
+        storage.close()
+        self.assertEqual(self.reopen(),
+                         [('changed memo', 'a b'), ('second memo', 'b'),
+                          ('third memo', 'c')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,225 @@
+import base64
 import hashlib
+import hmac
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSet
+from concurrent.futures import Future, ThreadPoolExecutor
 # Case study for a central authentication and authorisation system.
 
 # Constants
 MIN_PW_LENGTH = 6
 
+# Number of random bytes in the salt of each password hash.
+SALT_BYTES = 16
+
+# Number of seconds a session stays valid after logging in.
+SESSION_LIFETIME = 300
+
+# Maximum number of logins waiting for or undergoing password verification
+# on the login executor.
+MAX_PENDING_LOGINS = 64
+
+# Maximum number of users an Authenticator backed by an AuthStore keeps in
+# memory, not counting users that are logged in.
+USER_CACHE_SIZE = 10000
+
+
+def _b64encode(data):
+    """Encode bytes as unpadded base64 text."""
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text):
+    """Decode unpadded base64 text into bytes."""
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """
+    Base class for password hashers. A hasher derives a key from a password
+    and a random salt with a deliberately expensive key derivation function,
+    and encodes everything needed to check the password again into one string:
+
+        algorithm$param1$param2...$salt$hash
+
+    Subclasses set the algorithm name, return their tunable parameters from
+    params() and implement _derive().
+    """
+
+    algorithm = None
+
+    def params(self):
+        """Return the integer parameters of the key derivation function."""
+        raise NotImplementedError
+
+    def _derive(self, password, salt):
+        """Derive the hash bytes from the password and salt bytes."""
+        raise NotImplementedError
+
+    def encode(self, password, salt=None):
+        """
+        Hash a password.
+        :param password: Password to hash.
+        :param salt: Salt bytes; a new random salt is used if not given.
+        :return: Encoded hash string.
+        """
+        if salt is None:
+            salt = os.urandom(SALT_BYTES)
+        digest = self._derive(password.encode("utf8"), salt)
+        fields = [self.algorithm] + [str(param) for param in self.params()]
+        return "$".join(fields + [_b64encode(salt), _b64encode(digest)])
+
+    def verify(self, password, encoded):
+        """
+        Return True if the password matches the encoded hash. The hash must
+        have been encoded with this hasher's parameters; use identify_hasher()
+        to get a hasher for any encoded hash.
+        """
+        salt, digest = encoded.rsplit("$", 2)[1:]
+        derived = self._derive(password.encode("utf8"), _b64decode(salt))
+        return hmac.compare_digest(derived, _b64decode(digest))
+
+    def needs_rehash(self, encoded):
+        """
+        Return True if the encoded hash was made with a different algorithm
+        or different parameters to this hasher.
+        """
+        fields = [self.algorithm] + [str(param) for param in self.params()]
+        return encoded.split("$")[:-2] != fields
+
+
+class PBKDF2Hasher(PasswordHasher):
+    """Hashes passwords with PBKDF2-HMAC-SHA256."""
+
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations=600000):
+        """
+        :param iterations: Number of HMAC iterations; more iterations make
+        each hash slower to compute and to brute force.
+        """
+        self.iterations = iterations
+
+    def params(self):
+        return (self.iterations,)
+
+    def _derive(self, password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password, salt, self.iterations)
+
+
+class ScryptHasher(PasswordHasher):
+    """
+    Hashes passwords with scrypt, which needs a large amount of memory as well
+    as time to compute. Requires Python to be built with OpenSSL 1.1 or later.
+    """
+
+    algorithm = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        """
+        :param n: CPU and memory cost; must be a power of two.
+        :param r: Block size.
+        :param p: Parallelisation.
+        """
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def params(self):
+        return (self.n, self.r, self.p)
+
+    def _derive(self, password, salt):
+        # Allow for the 128 * n * r bytes scrypt needs, plus some headroom.
+        return hashlib.scrypt(password, salt=salt, n=self.n, r=self.r,
+                              p=self.p, maxmem=256 * self.n * self.r,
+                              dklen=32)
+
+
+# Hasher classes by the algorithm name at the start of an encoded hash.
+HASHERS = {hasher.algorithm: hasher for hasher in (PBKDF2Hasher, ScryptHasher)}
+
+# Hasher used for new passwords when none is given.
+default_hasher = PBKDF2Hasher()
+
+
+def identify_hasher(encoded):
+    """
+    Return a hasher with the algorithm and parameters of an encoded hash.
+    :raise: ValueError if the algorithm is unknown.
+    """
+    fields = encoded.split("$")
+    try:
+        hasher_class = HASHERS[fields[0]]
+    except KeyError:
+        raise ValueError("Unknown password hash algorithm")
+    return hasher_class(*(int(param) for param in fields[1:-2]))
+
+
+def check_and_rehash(password, encoded, hasher):
+    """
+    Check a password against an encoded hash and, if it is valid but was made
+    with different parameters to the hasher, hash it again. This is a module
+    level function so that it can be run on a process pool.
+    :param password: Password to check.
+    :param encoded: Encoded hash of the user's password.
+    :param hasher: PasswordHasher that new hashes should be made with.
+    :return: tuple of whether the password is valid and the new encoded hash,
+    or None if it does not need to change.
+    """
+    if not identify_hasher(encoded).verify(password, encoded):
+        return False, None
+    if hasher.needs_rehash(encoded):
+        return True, hasher.encode(password)
+    return True, None
+
 
 class User:
     """
     User class is responsible for storing the username and encrypted password.
     """
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, hasher=None):
         """
         Create a new user object. The password will be encrypted before storing.
         :param username: User's user name.
         :param password: User's password.
+        :param hasher: PasswordHasher used to encrypt the password; defaults
+        to default_hasher.
         """
         self.username = username
-        self.password = self._encrypt_pw(password)
+        self.password = self._encrypt_pw(password, hasher)
         self.is_logged_in = False
 
-    def _encrypt_pw(self, password):
-        """Encrypt the password with the username and return the sha digest."""
-        hash_string = (self.username + password)
-        hash_string = hash_string.encode("utf8")
-        return hashlib.sha256(hash_string).hexdigest()
+    @classmethod
+    def from_hash(cls, username, encoded):
+        """
+        Create a user object from an already encoded password hash, e.g. one
+        loaded from an AuthStore.
+        """
+        user = cls.__new__(cls)
+        user.username = username
+        user.password = encoded
+        user.is_logged_in = False
+        return user
+
+    def _encrypt_pw(self, password, hasher=None):
+        """Hash the password with a new salt and return the encoded hash."""
+        return (hasher or default_hasher).encode(password)
+
+    def set_password(self, password, hasher=None):
+        """Replace the user's password."""
+        self.password = self._encrypt_pw(password, hasher)
 
     def check_password(self, password):
         """
         Return True if the password is valid for this user, false otherwise.
         """
-        encrypted = self._encrypt_pw(password)
-        return encrypted == self.password
+        return identify_hasher(self.password).verify(password, self.password)
 
 
 class AuthException(Exception):
@@ -69,16 +257,268 @@ class InvalidPassword(AuthException):
     pass
 
 
+class InvalidSession(Exception):
+    """The session token does not exist or has expired."""
+    pass
+
+
+class LoginQueueFull(AuthException):
+    """Too many logins are already waiting for password verification."""
+    pass
+
+
+class AuthStore:
+    """
+    SQLite database holding the users of an Authenticator and the permissions
+    and roles of an Authorisor, so that they survive restarts and can be
+    shared by several processes. Each process must open its own AuthStore,
+    e.g. after forking. The store can be used from several threads.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS permissions (
+            name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS grants (
+            permission TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (permission, username)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS grants_by_user ON grants (username);
+        CREATE TABLE IF NOT EXISTS roles (
+            name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS role_parents (
+            role TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            PRIMARY KEY (role, parent)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS role_grants (
+            permission TEXT NOT NULL,
+            role TEXT NOT NULL,
+            PRIMARY KEY (permission, role)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS role_members (
+            role TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (role, username)) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        """
+        Open or create the database.
+        :param path: File name of the database.
+        """
+        # Statements are committed as they are executed, apart from the bulk
+        # changes made by executemany().
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          check_same_thread=False,
+                                          timeout=30)
+        self.lock = threading.Lock()
+        # Write ahead logging lets other processes read while one writes.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def query(self, sql, parameters=()):
+        """Run a query and return all of the rows it selects."""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def query_all(self, queries):
+        """
+        Run several queries in one transaction, so that they all see the
+        same state of the database.
+        :param queries: Iterable of SQL queries.
+        :return: list of the rows selected by each query.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                return [self.connection.execute(sql).fetchall()
+                        for sql in queries]
+            finally:
+                self.connection.execute("COMMIT")
+
+    def execute(self, sql, parameters=()):
+        """Run and commit a statement."""
+        with self.lock:
+            self.connection.execute(sql, parameters)
+
+    def executemany(self, sql, rows):
+        """
+        Run a statement for each row, all in one transaction, which is much
+        faster than committing each row separately. If any row fails, none
+        of them are stored.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(sql, rows)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def execute_all(self, statements):
+        """
+        Run several statements in one transaction, so that either all or
+        none of them are stored.
+        :param statements: Iterable of (sql, parameters) pairs.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for sql, parameters in statements:
+                    self.connection.execute(sql, parameters)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def data_version(self):
+        """
+        Return a number that changes whenever another connection, in this or
+        another process, commits a change to the database. Changes made
+        through this store do not change it.
+        """
+        return self.query("PRAGMA data_version")[0][0]
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.connection.close()
+
+
+class UserStore(MutableMapping):
+    """
+    Dictionary of usernames to User objects backed by an AuthStore. Users are
+    loaded when first used and the most recently used ones are kept in
+    memory. Users that are logged in are never dropped from memory, because
+    being logged in is not stored in the database.
+    """
+
+    def __init__(self, store, cache_size=USER_CACHE_SIZE):
+        """
+        :param store: AuthStore holding the users.
+        :param cache_size: Maximum number of users kept in memory, not
+        counting users that are logged in.
+        """
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._logged_in = {}
+        self._lock = threading.RLock()
+
+    def _remember(self, user):
+        """Add a user to the cache, evicting the least recently used."""
+        self._cache[user.username] = user
+        self._cache.move_to_end(user.username)
+        while len(self._cache) > self.cache_size:
+            username, evicted = self._cache.popitem(last=False)
+            if evicted.is_logged_in:
+                self._logged_in[username] = evicted
+
+    def __getitem__(self, username):
+        with self._lock:
+            user = self._logged_in.get(username)
+            if user is not None:
+                return user
+            user = self._cache.get(username)
+            if user is not None:
+                self._cache.move_to_end(username)
+                return user
+            rows = self.store.query(
+                "SELECT password FROM users WHERE username = ?", (username,))
+            if not rows:
+                raise KeyError(username)
+            user = User.from_hash(username, rows[0][0])
+            self._remember(user)
+            return user
+
+    def mark_logged_in(self, user):
+        """
+        Mark a user as logged in. The user may have been dropped from the
+        cache while their password was being checked, so they are kept in
+        memory from here, in place of any copy loaded since.
+        """
+        with self._lock:
+            user.is_logged_in = True
+            if self._cache.get(user.username) is not user:
+                self._cache.pop(user.username, None)
+                self._logged_in[user.username] = user
+
+    def __setitem__(self, username, user):
+        """Store a new user, or the changed password of a user."""
+        self.store.execute("INSERT OR REPLACE INTO users VALUES (?, ?)",
+                           (username, user.password))
+        with self._lock:
+            self._logged_in.pop(username, None)
+            self._remember(user)
+
+    def __delitem__(self, username):
+        if username not in self:
+            raise KeyError(username)
+        self.store.execute("DELETE FROM users WHERE username = ?",
+                           (username,))
+        with self._lock:
+            self._logged_in.pop(username, None)
+            self._cache.pop(username, None)
+
+    def __iter__(self):
+        rows = self.store.query("SELECT username FROM users ORDER BY username")
+        return (username for username, in rows)
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM users")[0][0]
+
+    def import_users(self, users):
+        """
+        Store many users in one transaction. The users are not loaded into
+        memory.
+        :param users: Iterable of (username, encoded password hash) pairs.
+        :raise: sqlite3.IntegrityError if a username already exists, in which
+        case none of the users are stored.
+        """
+        self.store.executemany("INSERT INTO users VALUES (?, ?)", users)
+
+
 class Authenticator:
     """
     Class used to manage users and logging in and out.
     """
 
-    def __init__(self):
-        """Construct an authenticator to manage users logging in and out."""
+    def __init__(self, hasher=None, session_lifetime=SESSION_LIFETIME,
+                 executor=None, max_pending_logins=MAX_PENDING_LOGINS,
+                 store=None, cache_size=USER_CACHE_SIZE):
+        """
+        Construct an authenticator to manage users logging in and out.
+        :param hasher: PasswordHasher for new and rehashed passwords; defaults
+        to default_hasher.
+        :param session_lifetime: Number of seconds a session stays valid.
+        :param executor: concurrent.futures executor that login_async() runs
+        password verification on. The hashlib key derivation functions
+        release the GIL, so the default thread pool uses every core; pass a
+        ProcessPoolExecutor for hashers written in pure Python.
+        :param max_pending_logins: Maximum number of logins queued on or
+        running on the executor.
+        :param store: Optional AuthStore to keep the users in.
+        :param cache_size: Maximum number of users from the store that are
+        kept in memory.
+        """
         # This class is responsible for maintaining a mapping of usernames to
-        # user objects. This is implemented using a dictionary.
-        self.users = {}
+        # user objects. This is implemented using a dictionary, or a
+        # UserStore with the same interface if the users are stored in an
+        # AuthStore.
+        self.users = UserStore(store, cache_size) if store is not None else {}
+        self.hasher = hasher or default_hasher
+        # Sessions of users that have logged in, so that they can be checked
+        # again without re-running the expensive password hash:
+        # key   = random session token.
+        # value = (username, time at which the session expires).
+        self.sessions = {}
+        self.session_lifetime = session_lifetime
+        self._next_session_prune = 0
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._login_slots = threading.BoundedSemaphore(max_pending_logins)
 
     def add_user(self, username, password):
         """Create and add a new user to the Authenticator."""
@@ -86,7 +526,22 @@ class Authenticator:
             raise UsernameAlreadyExists(username)
         if len(password) < MIN_PW_LENGTH:
             raise PasswordTooShort(username)
-        self.users[username] = User(username, password)
+        self.users[username] = User(username, password, self.hasher)
+
+    def import_users(self, users):
+        """
+        Add many users whose passwords have already been hashed, e.g. when
+        moving them from another system. Their passwords are rehashed with
+        this authenticator's hasher as they log in.
+        :param users: Iterable of (username, encoded password hash) pairs.
+        """
+        if isinstance(self.users, UserStore):
+            self.users.import_users(users)
+        else:
+            for username, encoded in users:
+                if username in self.users:
+                    raise UsernameAlreadyExists(username)
+                self.users[username] = User.from_hash(username, encoded)
 
     def login(self, username, password):
         """
@@ -103,12 +558,138 @@ class Authenticator:
         except KeyError:
             raise InvalidUsername(username)
 
-        if not user.check_password(password):
+        # The password is only known while logging in, so this is the moment
+        # to upgrade a hash made with an older algorithm or weaker parameters.
+        valid, rehashed = check_and_rehash(password, user.password,
+                                           self.hasher)
+        if not valid:
             raise InvalidPassword(username, user)
+        if rehashed is not None:
+            user.password = rehashed
+            # Save the new hash if the users are stored.
+            self.users[username] = user
 
-        user.is_logged_in = True
+        self._mark_logged_in(user)
         return True
 
+    def _mark_logged_in(self, user):
+        """Mark a user whose password has been checked as logged in."""
+        if isinstance(self.users, UserStore):
+            self.users.mark_logged_in(user)
+        else:
+            user.is_logged_in = True
+
+    @property
+    def executor(self):
+        """Executor used by login_async(), created when first needed."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                thread_name_prefix="login")
+        return self._executor
+
+    def login_async(self, username, password, timeout=0):
+        """
+        Log in a user without blocking the calling thread while the password
+        is checked. The password is checked on the executor; use
+        asyncio.wrap_future() to await the result in a coroutine.
+        :param username: Username of user trying to log in.
+        :param password: Password of user trying to log in.
+        :param timeout: Number of seconds to wait for room in the login queue,
+        or None to wait as long as it takes.
+        :return: Future that is resolved to True for a successful login, or
+        fails with InvalidUsername or InvalidPassword as for login().
+        :raise: LoginQueueFull if the login queue stays full for the timeout,
+        so that a burst of logins is turned away instead of delaying every
+        other request.
+        """
+        result = Future()
+        try:
+            user = self.users[username]
+        except KeyError:
+            result.set_exception(InvalidUsername(username))
+            return result
+
+        if not self._login_slots.acquire(timeout=timeout):
+            raise LoginQueueFull(username, user)
+        encoded = user.password
+        try:
+            check = self.executor.submit(check_and_rehash, password, encoded,
+                                         self.hasher)
+        except BaseException:
+            self._login_slots.release()
+            raise
+
+        def finish(check):
+            self._login_slots.release()
+            # Exceptions raised by a done callback are only logged, so every
+            # failure, including one saving the new hash, goes to the result.
+            try:
+                valid, rehashed = check.result()
+                if not valid:
+                    raise InvalidPassword(username, user)
+                # Keep a password that was changed while this one was
+                # checked.
+                if rehashed is not None and user.password == encoded:
+                    user.password = rehashed
+                    self.users[username] = user
+                self._mark_logged_in(user)
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result(True)
+
+        check.add_done_callback(finish)
+        return result
+
+    def shutdown(self):
+        """Stop the login executor, if this authenticator created it."""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def open_session(self, username, password):
+        """
+        Log in a user and start a session for them.
+        :param username: Username of user trying to log in.
+        :param password: Password of user trying to log in.
+        :return: Session token to pass to check_session().
+        :raise: InvalidUsername or InvalidPassword as for login().
+        """
+        self.login(username, password)
+        now = time.monotonic()
+        if now >= self._next_session_prune:
+            self._prune_sessions(now)
+        token = secrets.token_urlsafe()
+        self.sessions[token] = (username, now + self.session_lifetime)
+        return token
+
+    def check_session(self, token):
+        """
+        Check a session token without checking the password again.
+        :param token: Token returned by open_session().
+        :return: Username of the session's user.
+        :raise: InvalidSession if the session does not exist or has expired.
+        """
+        try:
+            username, expires = self.sessions[token]
+        except KeyError:
+            raise InvalidSession("Session does not exist")
+        if time.monotonic() >= expires:
+            del self.sessions[token]
+            raise InvalidSession("Session has expired")
+        return username
+
+    def close_session(self, token):
+        """End a session, if it exists."""
+        self.sessions.pop(token, None)
+
+    def _prune_sessions(self, now):
+        """Forget the expired sessions, at most once per session lifetime."""
+        self.sessions = {token: session
+                         for token, session in self.sessions.items()
+                         if session[1] > now}
+        self._next_session_prune = now + self.session_lifetime
+
     def is_logged_in(self, username):
         """True if a user is logged in, False otherwise."""
         if username in self.users:
@@ -136,25 +717,230 @@ class NotPermittedError(AuthException):
     pass
 
 
+class PermissionSet(MutableSet):
+    """Set of the usernames granted one permission in an AuthStore."""
+
+    def __init__(self, store, perm_name):
+        self.store = store
+        self.perm_name = perm_name
+
+    def __contains__(self, username):
+        return bool(self.store.query(
+            "SELECT 1 FROM grants WHERE permission = ? AND username = ?",
+            (self.perm_name, username)))
+
+    def __iter__(self):
+        rows = self.store.query(
+            "SELECT username FROM grants WHERE permission = ?",
+            (self.perm_name,))
+        return (username for username, in rows)
+
+    def __len__(self):
+        return self.store.query(
+            "SELECT COUNT(*) FROM grants WHERE permission = ?",
+            (self.perm_name,))[0][0]
+
+    def add(self, username):
+        self.store.execute("INSERT OR IGNORE INTO grants VALUES (?, ?)",
+                           (self.perm_name, username))
+
+    def discard(self, username):
+        self.store.execute(
+            "DELETE FROM grants WHERE permission = ? AND username = ?",
+            (self.perm_name, username))
+
+
+class PermissionStore(MutableMapping):
+    """
+    Dictionary of permission names to sets of usernames backed by an
+    AuthStore. The permission names are loaded when it is created, and
+    reloaded when a name is not found, in case the permission was created
+    through another connection; the usernames granted each permission are
+    only read when needed.
+    """
+
+    def __init__(self, store):
+        """:param store: AuthStore holding the permissions."""
+        self.store = store
+        self.refresh()
+
+    def refresh(self):
+        """Reload the permission names from the store."""
+        # Permission names in the order they were created.
+        self._names = dict.fromkeys(name for name, in self.store.query(
+            "SELECT name FROM permissions ORDER BY rowid"))
+
+    def _exists(self, perm_name):
+        """
+        Return True if the permission exists, reloading the names if it is
+        not known yet.
+        """
+        if perm_name not in self._names:
+            self.refresh()
+        return perm_name in self._names
+
+    def __getitem__(self, perm_name):
+        if not self._exists(perm_name):
+            raise KeyError(perm_name)
+        return PermissionSet(self.store, perm_name)
+
+    def __setitem__(self, perm_name, usernames):
+        """Create a permission granted to the given usernames."""
+        self.store.execute("INSERT OR IGNORE INTO permissions VALUES (?)",
+                           (perm_name,))
+        self._names[perm_name] = None
+        self.store.executemany(
+            "INSERT OR IGNORE INTO grants VALUES (?, ?)",
+            ((perm_name, username) for username in usernames))
+
+    def __delitem__(self, perm_name):
+        if not self._exists(perm_name):
+            raise KeyError(perm_name)
+        self.store.execute("DELETE FROM grants WHERE permission = ?",
+                           (perm_name,))
+        self.store.execute("DELETE FROM permissions WHERE name = ?",
+                           (perm_name,))
+        self._names.pop(perm_name, None)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def granted_to(self, username):
+        """Return the names of the permissions granted to a user."""
+        return [name for name, in self.store.query(
+            "SELECT permission FROM grants WHERE username = ?", (username,))]
+
+
+class Role:
+    """
+    A named set of permissions that can be assigned to users. A role inherits
+    the permissions of its parent roles, so a role can also be used as a group
+    of other roles.
+    """
+
+    def __init__(self, name, parents=()):
+        """
+        :param name: Name of the role.
+        :param parents: Roles whose permissions this role inherits.
+        """
+        self.name = name
+        self.parents = list(parents)
+        # Roles that inherit from this role.
+        self.children = []
+        # Bitset of the permissions granted to this role itself.
+        self.permissions = 0
+        # Usernames of the users assigned this role.
+        self.members = set()
+        for parent in self.parents:
+            parent.children.append(self)
+
+    def descendants(self):
+        """Return this role and every role that inherits from it."""
+        roles = [self]
+        seen = {self.name}
+        for role in roles:
+            for child in role.children:
+                if child.name not in seen:
+                    seen.add(child.name)
+                    roles.append(child)
+        return roles
+
+
 class Authorisor:
     """
     Responsible for mapping permissions to users. This class manages permissions
     and it will not permit user access to a permission if the user is not logged
     in.
+
+    Permissions can be granted to users directly or through roles. Each
+    permission is given a bit number, and the effective permissions of each
+    user are cached as a bitset, so a check is a single bit test. The cache is
+    updated incrementally when permissions are granted and entries are
+    dropped, to be recomputed on the next check, when they are revoked.
+
+    With an AuthStore, the roles are kept in the store too and loaded into
+    memory. Before each check the Authorisor asks the store whether another
+    connection has changed it, and if so reloads the permissions and roles
+    and drops the cached bitsets.
     """
 
-    def __init__(self, authenticator):
+    def __init__(self, authenticator, store=None):
         """
         Initialise a new Authorisor object with the specified Authenticator.
         :param authenticator: Authenticator object containing User information.
+        :param store: Optional AuthStore to keep the permissions and roles
+        in.
         """
         self.authenticator = authenticator
+        self.store = store
         # Permissions are stored in a dictionary consisting of:
         # key   = the name of the permission.
         # value = set of usernames assigned that permission. The set ensures
         # that if a user is granted the same permission multiple times, the
         # permission set will only contain one entry for that user.
-        self.permissions = {}
+        # A PermissionStore is used instead if the permissions are stored in
+        # an AuthStore.
+        self.permissions = PermissionStore(store) if store is not None \
+            else {}
+        # Bit number of each permission in the permission bitsets.
+        self._permission_bits = {name: bit for bit, name in
+                                 enumerate(self.permissions)}
+        # Roles by name, and the names of the roles of each user.
+        self.roles = {}
+        self._user_roles = {}
+        # Cached effective permission bitsets of roles and users by name.
+        self._role_masks = {}
+        self._user_masks = {}
+        if store is not None:
+            self._load()
+
+    def _load(self):
+        """
+        Load the permissions and roles from the store, dropping the cached
+        bitsets.
+        """
+        # Read first, so that changes made while loading cause another load.
+        self._data_version = self.store.data_version()
+        names, role_names, role_parents, role_grants, role_members = \
+            self.store.query_all([
+                "SELECT name FROM permissions ORDER BY rowid",
+                "SELECT name FROM roles ORDER BY rowid",
+                "SELECT role, parent FROM role_parents",
+                "SELECT permission, role FROM role_grants",
+                "SELECT role, username FROM role_members"])
+        self.permissions.refresh()
+        self._permission_bits = {name: bit for bit, (name,) in
+                                 enumerate(names)}
+        parents = {}
+        for role_name, parent in role_parents:
+            parents.setdefault(role_name, []).append(parent)
+        # Roles are created after their parents, so loading them in the
+        # order they were created finds the parents already loaded.
+        self.roles = {}
+        for role_name, in role_names:
+            self.roles[role_name] = Role(role_name, [
+                self.roles[parent] for parent in parents.get(role_name, ())])
+        for perm_name, role_name in role_grants:
+            self.roles[role_name].permissions |= \
+                1 << self._permission_bits[perm_name]
+        self._user_roles = {}
+        for role_name, username in role_members:
+            self.roles[role_name].members.add(username)
+            self._user_roles.setdefault(username, set()).add(role_name)
+        self._role_masks = {}
+        self._user_masks = {}
+
+    def _check_store(self):
+        """
+        Reload the permissions and roles if another connection has changed
+        the store since they were loaded.
+        """
+        if self.store is not None and \
+                self.store.data_version() != self._data_version:
+            self._load()
 
     def add_permission(self, perm_name):
         """
@@ -172,10 +958,51 @@ class Authorisor:
             # Create the permission set to store users authorised with this
             # permission
             self.permissions[perm_name] = set()
+            self._permission_bits[perm_name] = len(self._permission_bits)
         else:
             # Permission (names) must be unique in this Authorisor.
             raise AuthPermissionError("Permission already exists")
 
+    def _permission_bit(self, perm_name):
+        """
+        Return the bitset with only the given permission's bit set.
+        :raise: AuthPermissionError if the permission does not exist.
+        """
+        bit = self._permission_bits.get(perm_name)
+        if bit is None and self.store is not None:
+            # The permission may have been created through another
+            # connection, so give any new permissions the next bits.
+            self.permissions.refresh()
+            for name in self.permissions:
+                if name not in self._permission_bits:
+                    self._permission_bits[name] = len(self._permission_bits)
+            bit = self._permission_bits.get(perm_name)
+        if bit is None:
+            raise AuthPermissionError("Permission does not exist")
+        return 1 << bit
+
+    def _role(self, role_name):
+        """
+        Return the role with the given name.
+        :raise: AuthPermissionError if the role does not exist.
+        """
+        role = self.roles.get(role_name)
+        if role is None and self.store is not None:
+            # The role may have been created through another connection.
+            self._load()
+            role = self.roles.get(role_name)
+        if role is None:
+            raise AuthPermissionError("Role does not exist")
+        return role
+
+    def _check_user(self, username):
+        """
+        :raise: InvalidUsername if the username is not known to the
+        Authenticator.
+        """
+        if username not in self.authenticator.users:
+            raise InvalidUsername(username)
+
     def permit_user(self, perm_name, username):
         """
         Grant the given permission to the user.
@@ -196,16 +1023,152 @@ class Authorisor:
         else:
             # Validate the username. The username must be known to the
             # Authenticator.
-            if username not in self.authenticator.users:
-                raise InvalidUsername(username)
+            self._check_user(username)
             # Add the known user to the permission set.
             perm_set.add(username)
+            if username in self._user_masks:
+                self._user_masks[username] |= self._permission_bit(perm_name)
+
+    def revoke_user(self, perm_name, username):
+        """
+        Withdraw a permission granted directly to the user. Permissions the
+        user has through roles are not affected.
+        :raise: AuthPermissionError if the permission does not exist.
+        """
+        try:
+            self.permissions[perm_name].discard(username)
+        except KeyError:
+            raise AuthPermissionError("Permission does not exist")
+        self._user_masks.pop(username, None)
+
+    def add_role(self, role_name, parents=()):
+        """
+        Create a new role.
+        :param role_name: Name of the new role.
+        :param parents: Names of existing roles whose permissions the new role
+        inherits.
+        :return: None
+        :raise: AuthPermissionError if the role already exists or a parent
+        role does not exist.
+        """
+        if role_name in self.roles:
+            raise AuthPermissionError("Role already exists")
+        parents = [self._role(parent) for parent in parents]
+        if self.store is not None:
+            try:
+                self.store.execute_all(
+                    [("INSERT INTO roles VALUES (?)", (role_name,))] +
+                    [("INSERT INTO role_parents VALUES (?, ?)",
+                      (role_name, parent.name)) for parent in parents])
+            except sqlite3.IntegrityError:
+                # Created through another connection.
+                self._load()
+                raise AuthPermissionError("Role already exists")
+        self.roles[role_name] = Role(role_name, parents)
+
+    def permit_role(self, perm_name, role_name):
+        """
+        Grant the given permission to a role, and so to every user with that
+        role or a role inheriting from it.
+        :raise: AuthPermissionError if the permission or role does not exist.
+        """
+        bit = self._permission_bit(perm_name)
+        role = self._role(role_name)
+        if self.store is not None:
+            self.store.execute(
+                "INSERT OR IGNORE INTO role_grants VALUES (?, ?)",
+                (perm_name, role_name))
+        role.permissions |= bit
+        for affected in role.descendants():
+            if affected.name in self._role_masks:
+                self._role_masks[affected.name] |= bit
+            for username in affected.members:
+                if username in self._user_masks:
+                    self._user_masks[username] |= bit
+
+    def revoke_role(self, perm_name, role_name):
+        """
+        Withdraw a permission granted to a role.
+        :raise: AuthPermissionError if the permission or role does not exist.
+        """
+        bit = self._permission_bit(perm_name)
+        role = self._role(role_name)
+        if self.store is not None:
+            self.store.execute(
+                "DELETE FROM role_grants WHERE permission = ? AND role = ?",
+                (perm_name, role_name))
+        role.permissions &= ~bit
+        for affected in role.descendants():
+            self._role_masks.pop(affected.name, None)
+            for username in affected.members:
+                self._user_masks.pop(username, None)
+
+    def assign_role(self, role_name, username):
+        """
+        Give a user a role.
+        :raise: AuthPermissionError if the role does not exist.
+        :raise: InvalidUsername if the username is not known to the
+        Authenticator.
+        """
+        role = self._role(role_name)
+        self._check_user(username)
+        if self.store is not None:
+            self.store.execute(
+                "INSERT OR IGNORE INTO role_members VALUES (?, ?)",
+                (role_name, username))
+        role.members.add(username)
+        self._user_roles.setdefault(username, set()).add(role_name)
+        if username in self._user_masks:
+            self._user_masks[username] |= self._role_mask(role)
+
+    def unassign_role(self, role_name, username):
+        """
+        Take a role away from a user.
+        :raise: AuthPermissionError if the role does not exist.
+        """
+        role = self._role(role_name)
+        if self.store is not None:
+            self.store.execute(
+                "DELETE FROM role_members WHERE role = ? AND username = ?",
+                (role_name, username))
+        role.members.discard(username)
+        self._user_roles.get(username, set()).discard(role_name)
+        self._user_masks.pop(username, None)
+
+    def _role_mask(self, role):
+        """Return the bitset of a role's own and inherited permissions."""
+        try:
+            return self._role_masks[role.name]
+        except KeyError:
+            mask = role.permissions
+            for parent in role.parents:
+                mask |= self._role_mask(parent)
+            self._role_masks[role.name] = mask
+            return mask
+
+    def _user_mask(self, username):
+        """Return the bitset of a user's effective permissions."""
+        try:
+            return self._user_masks[username]
+        except KeyError:
+            mask = 0
+            if isinstance(self.permissions, PermissionStore):
+                granted = self.permissions.granted_to(username)
+            else:
+                granted = [perm_name for perm_name, perm_set
+                           in self.permissions.items() if username in perm_set]
+            for perm_name in granted:
+                mask |= self._permission_bit(perm_name)
+            for role_name in self._user_roles.get(username, ()):
+                mask |= self._role_mask(self.roles[role_name])
+            self._user_masks[username] = mask
+            return mask
 
     def check_permission(self, perm_name, username):
         """
         Check whether a user has a specific permission. In order for them to be
         granted access, they have to be both logged into the authenticator and
-        in the set of users who have been granted access to that privilege.
+        have been granted that privilege, directly or through a role.
         :param perm_name: Permission name.
         :param username: Username to check for permission.
         :return: True if username has the permission; False otherwise.
@@ -217,15 +1180,17 @@ class Authorisor:
         # Users must be logged in to have any permissions at all
         if not self.authenticator.is_logged_in(username):
             raise NotLoggedInError(username)
+        # Drop the cached bitsets if the store has changed.
+        self._check_store()
         try:
-            # Get the permission set for the specified permission name
-            perm_set = self.permissions[perm_name]
-        except KeyError:
+            # Get the bit of the specified permission name
+            bit = self._permission_bit(perm_name)
+        except AuthPermissionError:
             # Permission (name) does not exist in this Authorisor
             raise PermissionError("Permission does not exist")
         else:
-            # Username must be in the permission set to be authorised
-            if username not in perm_set:
+            # The permission's bit must be set in the user's permissions
+            if not self._user_mask(username) & bit:
                 raise NotPermittedError(username)
             else:
                 # User is logged in and they have the necessary privilege
@@ -237,6 +1202,21 @@ class Authorisor:
 authorisor = Authorisor(authenticator)
 
 
+def use_store(path, cache_size=USER_CACHE_SIZE):
+    """
+    Replace the default authenticator and authorisor with ones that keep
+    their users and permissions in an SQLite database.
+    :param path: File name of the database.
+    :param cache_size: Maximum number of users kept in memory.
+    :return: the AuthStore, to be closed when it is no longer needed.
+    """
+    global authenticator, authorisor
+    store = AuthStore(path)
+    authenticator = Authenticator(store=store, cache_size=cache_size)
+    authorisor = Authorisor(authenticator, store=store)
+    return store
+
+
 # Demonstration code
 def main():
     authenticator.add_user("joe", "joepassword")
@@ -257,6 +1237,12 @@ def main():
         print("Permission exception: %s" % e)
     authorisor.permit_user("paint", "joe")
     print("Can joe paint: %s" % (authorisor.check_permission("paint", "joe")))
+    authorisor.add_permission("mix")
+    authorisor.add_role("painter")
+    authorisor.add_role("master painter", parents=["painter"])
+    authorisor.permit_role("mix", "painter")
+    authorisor.assign_role("master painter", "joe")
+    print("Can joe mix: %s" % (authorisor.check_permission("mix", "joe")))
 
 
 # Import guard
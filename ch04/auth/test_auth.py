@@ -0,0 +1,117 @@
+from auth import AuthStore, Authenticator, PBKDF2Hasher, User
+from concurrent.futures import Future
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+"""
+Tests of logging in to an Authenticator backed by an AuthStore.
+"""
+
+
+class TestLoginAsync(unittest.TestCase):
+    def setUp(self):
+        """
+        Create an authenticator backed by a new store, with a user whose
+        password was hashed with weaker parameters than the authenticator's
+        hasher, so that logging in rehashes it.
+        :return: None
+        """
+        self.directory = tempfile.mkdtemp()
+        self.store = AuthStore(os.path.join(self.directory, 'auth.db'))
+        self.authenticator = Authenticator(hasher=PBKDF2Hasher(2000),
+                                           store=self.store)
+        old = User('joe', 'joepassword', PBKDF2Hasher(1000))
+        self.authenticator.import_users([('joe', old.password)])
+
+    def tearDown(self):
+        self.authenticator.shutdown()
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_rehash_saved(self):
+        future = self.authenticator.login_async('joe', 'joepassword')
+        self.assertTrue(future.result(timeout=10))
+        self.assertTrue(self.authenticator.is_logged_in('joe'))
+        password, = self.store.query(
+            "SELECT password FROM users WHERE username = 'joe'")[0]
+        self.assertFalse(PBKDF2Hasher(2000).needs_rehash(password))
+
+    def test_failure_saving_rehash(self):
+        def execute(sql, parameters=()):
+            raise sqlite3.OperationalError("database is locked")
+
+        self.store.execute = execute
+        self.authenticator = Authenticator(hasher=PBKDF2Hasher(2000),
+                                           max_pending_logins=1,
+                                           store=self.store)
+        future = self.authenticator.login_async('joe', 'joepassword')
+        with self.assertRaises(sqlite3.OperationalError):
+            future.result(timeout=10)
+        # The login slot was given back, so another login is not turned away.
+        del self.store.execute
+        future = self.authenticator.login_async('joe', 'joepassword')
+        self.assertTrue(future.result(timeout=10))
+
+
+class ManualExecutor:
+    """Executor that only runs the submitted calls when told to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.calls.append((future, fn, args))
+        return future
+
+    def run(self):
+        for future, fn, args in self.calls:
+            future.set_result(fn(*args))
+        self.calls = []
+
+
+class TestEvictionDuringLogin(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = AuthStore(os.path.join(self.directory, 'auth.db'))
+        self.executor = ManualExecutor()
+        self.authenticator = Authenticator(
+            hasher=PBKDF2Hasher(1000), executor=self.executor,
+            store=self.store, cache_size=2)
+        for username in ('a', 'b', 'c'):
+            self.authenticator.add_user(username, username + 'password')
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_evicted_while_checking(self):
+        future = self.authenticator.login_async('c', 'cpassword')
+        # Loading other users drops c from the cache before the password
+        # check finishes.
+        self.assertFalse(self.authenticator.is_logged_in('a'))
+        self.assertFalse(self.authenticator.is_logged_in('b'))
+        self.executor.run()
+        self.assertTrue(future.result(timeout=0))
+        self.assertTrue(self.authenticator.is_logged_in('c'))
+        # c stays logged in however many other users are loaded.
+        self.assertFalse(self.authenticator.is_logged_in('a'))
+        self.assertFalse(self.authenticator.is_logged_in('b'))
+        self.assertTrue(self.authenticator.is_logged_in('c'))
+
+    def test_reloaded_while_checking(self):
+        future = self.authenticator.login_async('c', 'cpassword')
+        self.authenticator.is_logged_in('a')
+        self.authenticator.is_logged_in('b')
+        # c is loaded again as a new object before the check finishes.
+        self.assertFalse(self.authenticator.is_logged_in('c'))
+        self.executor.run()
+        self.assertTrue(future.result(timeout=0))
+        self.assertTrue(self.authenticator.is_logged_in('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
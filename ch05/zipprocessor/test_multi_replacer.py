@@ -0,0 +1,81 @@
+from zipsearch import MultiReplacer
+import io
+import random
+import unittest
+
+"""
+Tests of MultiReplacer against a brute force search, with chunks small enough
+for matches to be split between chunks.
+"""
+
+
+def replace_all(data, replacements):
+    """
+    Replace the search strings at each position in turn, the longest first,
+    which replaces the leftmost, longest matches.
+    :return: the new data and the number of replacements made.
+    """
+    searches = sorted(replacements, key=len, reverse=True)
+    parts = []
+    count = 0
+    position = 0
+    while position < len(data):
+        for search in searches:
+            if data.startswith(search, position):
+                parts.append(replacements[search])
+                position += len(search)
+                count += 1
+                break
+        else:
+            parts.append(data[position:position + 1])
+            position += 1
+    return b"".join(parts), count
+
+
+class TestMultiReplacer(unittest.TestCase):
+    def check(self, data, replacements):
+        """Compare the replacer with replace_all() for small chunk sizes."""
+        replacer = MultiReplacer(replacements)
+        expected, expected_count = replace_all(data, replacements)
+        for chunk_size in range(1, 9):
+            target = io.BytesIO()
+            count = replacer.replace_stream(io.BytesIO(data), target,
+                                            chunk_size)
+            self.assertEqual(target.getvalue(), expected,
+                             (data, replacements, chunk_size))
+            self.assertEqual(count, expected_count)
+            self.assertEqual(
+                replacer.contains(io.BytesIO(data), chunk_size),
+                expected_count > 0)
+
+    def test_overlapping_matches(self):
+        self.check(b"ushers", {b"he": b"1", b"hers": b"2", b"she": b"3"})
+
+    def test_longest_at_same_start(self):
+        self.check(b"abcdabcabx", {b"a": b"1", b"abc": b"2", b"abcd": b"3",
+                                   b"bx": b"4"})
+
+    def test_no_match(self):
+        self.check(b"xyzxyz", {b"ab": b"1", b"xyy": b"2"})
+        self.check(b"", {b"ab": b"1"})
+
+    def test_random(self):
+        generator = random.Random(25)
+
+        def random_bytes(alphabet, min_length, max_length):
+            return bytes(generator.choice(alphabet) for _ in range(
+                generator.randint(min_length, max_length)))
+
+        for _ in range(300):
+            replacements = {
+                random_bytes(b"ab", 1, 4): random_bytes(b"xy_", 0, 3)
+                for _ in range(generator.randint(1, 5))}
+            self.check(random_bytes(b"abc", 0, 30), replacements)
+
+    def test_empty_search_string(self):
+        with self.assertRaises(ValueError):
+            MultiReplacer({b"": b"x"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from zip_processor import ZipProcessor
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+"""
+Tests of streaming a ZIP file through a ZipProcessor, in one process and in
+several, with stored, deflated and data descriptor members.
+"""
+
+
+class UpperCase(ZipProcessor):
+    """Upper cases the members, copying those already in upper case."""
+
+    def needs_processing(self, info, source):
+        return any(chunk != chunk.upper()
+                   for chunk in iter(lambda: source.read(1 << 16), b""))
+
+    def process_member(self, info, source, target):
+        target.write(source.read().upper())
+
+
+class Unseekable(io.RawIOBase):
+    """
+    Binary file that cannot seek, so that ZipFile writes a data descriptor
+    after each member.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.file.write(data)
+
+
+# Members of the test ZIP file: name, contents and compression method.
+MEMBERS = [
+    ("stored.txt", b"stored text\n" * 100, zipfile.ZIP_STORED),
+    ("deflated.txt", b"deflated text\n" * 1000, zipfile.ZIP_DEFLATED),
+    ("upper.txt", b"ALREADY UPPER CASE\n" * 100, zipfile.ZIP_DEFLATED),
+    ("empty.txt", b"", zipfile.ZIP_DEFLATED),
+]
+
+
+class TestStreamZip(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.zipname = os.path.join(self.directory, "test.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_zip(self, data_descriptors=False):
+        """
+        Write the test ZIP file, with a directory and the members in MEMBERS.
+        :param data_descriptors: write the members through a file that
+        cannot seek, so their sizes and CRCs follow their data.
+        """
+        with open(self.zipname, "wb") as file:
+            output = Unseekable(file) if data_descriptors else file
+            with zipfile.ZipFile(output, "w") as archive:
+                archive.comment = b"test comment"
+                archive.writestr(zipfile.ZipInfo("folder/"), b"")
+                for name, data, compress_type in MEMBERS:
+                    info = zipfile.ZipInfo("folder/" + name,
+                                           (2020, 1, 2, 3, 4, 6))
+                    info.compress_type = compress_type
+                    with archive.open(info, "w") as member:
+                        member.write(data)
+        with zipfile.ZipFile(self.zipname) as archive:
+            flags = [info.flag_bits & 0x08 for info in archive.infolist()[1:]]
+        self.assertEqual(all(flags), data_descriptors)
+
+    def check_zip(self):
+        """Check the streamed ZIP file is valid and upper cased."""
+        with zipfile.ZipFile(self.zipname) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.comment, b"test comment")
+            infos = archive.infolist()
+            self.assertEqual(
+                [info.filename for info in infos],
+                ["folder/"] + ["folder/" + name for name, _, _ in MEMBERS])
+            self.assertTrue(infos[0].is_dir())
+            for info, (name, data, compress_type) in zip(infos[1:], MEMBERS):
+                self.assertEqual(archive.read(info), data.upper())
+                self.assertEqual(info.compress_type, compress_type)
+                self.assertEqual(info.date_time, (2020, 1, 2, 3, 4, 6))
+
+    def test_serial(self):
+        self.write_zip()
+        UpperCase(self.zipname).stream_zip()
+        self.check_zip()
+
+    def test_parallel(self):
+        self.write_zip()
+        UpperCase(self.zipname).stream_zip(workers=2, max_in_flight=2)
+        self.check_zip()
+
+    def test_serial_data_descriptors(self):
+        self.write_zip(data_descriptors=True)
+        UpperCase(self.zipname).stream_zip()
+        self.check_zip()
+
+    def test_parallel_data_descriptors(self):
+        self.write_zip(data_descriptors=True)
+        UpperCase(self.zipname).stream_zip(workers=2)
+        self.check_zip()
+
+    def test_twice(self):
+        # Members copied from a streamed ZIP file are still valid.
+        self.write_zip(data_descriptors=True)
+        UpperCase(self.zipname).stream_zip(workers=2)
+        UpperCase(self.zipname).stream_zip()
+        self.check_zip()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+from zipsearch import contains_stream, replace_stream
+import io
+import unittest
+
+"""
+Tests of the chunked search and replace functions, with chunks small enough
+for the search string to be split between chunks.
+"""
+
+
+class TestContainsStream(unittest.TestCase):
+    def test_match_split_between_chunks(self):
+        for chunk_size in range(1, 8):
+            for start in range(10):
+                data = b"x" * start + b"needle" + b"x" * 3
+                self.assertTrue(
+                    contains_stream(io.BytesIO(data), b"needle", chunk_size),
+                    (chunk_size, start))
+
+    def test_no_match(self):
+        data = b"needl eedle neednee" * 3
+        for chunk_size in range(1, 8):
+            self.assertFalse(
+                contains_stream(io.BytesIO(data), b"needle", chunk_size),
+                chunk_size)
+
+    def test_single_byte(self):
+        self.assertTrue(contains_stream(io.BytesIO(b"abc"), b"c", 1))
+        self.assertFalse(contains_stream(io.BytesIO(b"abc"), b"d", 1))
+        self.assertFalse(contains_stream(io.BytesIO(b""), b"d", 1))
+
+
+class TestReplaceStream(unittest.TestCase):
+    def test_same_as_bytes_replace(self):
+        data = b"aabaabaaab" * 5
+        for search in (b"a", b"aa", b"aab", b"baa", b"abaab"):
+            for chunk_size in range(1, 9):
+                target = io.BytesIO()
+                count = replace_stream(io.BytesIO(data), target, search,
+                                       b"<>", chunk_size)
+                self.assertEqual(target.getvalue(),
+                                 data.replace(search, b"<>"))
+                self.assertEqual(count, data.count(search))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,112 @@
+import copy
 import os
 import shutil
+import struct
+import tempfile
 import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+# Positions of the file name and extra field lengths in a local file header.
+_FILENAME_LENGTH = 10
+_EXTRA_FIELD_LENGTH = 11
+
+# Header id of the ZIP64 record in the extra field of a member.
+_ZIP64_EXTRA_ID = 1
+
+# Flag bit set when a member's sizes and CRC follow its data.
+_DATA_DESCRIPTOR_FLAG = 0x08
+
+# Number of bytes copied at a time by copy_raw_member().
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def _strip_zip64_extra(extra):
+    """
+    Remove the ZIP64 record from the extra field of a member. ZipInfo adds a
+    new one when writing the member if its sizes need it.
+    """
+    records = []
+    while len(extra) >= 4:
+        header_id, size = struct.unpack("<HH", extra[:4])
+        if header_id != _ZIP64_EXTRA_ID:
+            records.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return b"".join(records)
+
+
+def copy_raw_member(source, info, target):
+    """
+    Copy a member from one ZIP file to another without decompressing and
+    recompressing it. ZipFile has no public method for this, so the member's
+    local header and compressed data are written to the target's file
+    directly, and the member is added to the target's central directory.
+    :param source: ZipFile opened for reading.
+    :param info: ZipInfo of the member in the source ZIP file.
+    :param target: ZipFile opened for writing, with no member open.
+    """
+    # The local header can have a different extra field to the central
+    # directory, so read its length to find where the data starts.
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(header[_FILENAME_LENGTH] + header[_EXTRA_FIELD_LENGTH],
+                   os.SEEK_CUR)
+
+    new_info = copy.copy(info)
+    new_info.extra = _strip_zip64_extra(info.extra)
+    # The sizes and CRC are known, so they go in the header instead of a
+    # data descriptor.
+    new_info.flag_bits &= ~_DATA_DESCRIPTOR_FLAG
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or \
+        info.compress_size > zipfile.ZIP64_LIMIT
+    new_info.header_offset = target.fp.tell()
+    target.fp.write(new_info.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining:
+        data = source.fp.read(min(remaining, COPY_CHUNK_SIZE))
+        if not data:
+            raise zipfile.BadZipFile(
+                "Truncated data for member {}".format(info.filename))
+        target.fp.write(data)
+        remaining -= len(data)
+    target.filelist.append(new_info)
+    target.NameToInfo[new_info.filename] = new_info
+    target.start_dir = target.fp.tell()
+
+
+# The processor and the ZIP file being read by a worker process of
+# ZipProcessor.stream_zip().
+_worker_processor = None
+_worker_zip = None
+
+
+def _init_worker(processor):
+    """Open the processor's ZIP file in a new worker process."""
+    global _worker_processor, _worker_zip
+    _worker_processor = processor
+    _worker_zip = zipfile.ZipFile(processor.zipname)
+
+
+def _process_in_worker(index, part_directory):
+    """
+    Process one member of the ZIP file in a worker process, writing the
+    result to a new ZIP file holding just that member.
+    :param index: Position of the member in the ZIP file.
+    :param part_directory: Directory to write the new ZIP file to.
+    :return: File name of the new ZIP file, or None if the member does not
+    need to change.
+    """
+    info = _worker_zip.infolist()[index]
+    if _worker_processor._is_unchanged(_worker_zip, info):
+        return None
+    handle, part_name = tempfile.mkstemp(suffix=".zip", dir=part_directory)
+    with os.fdopen(handle, 'wb') as part_file, \
+            zipfile.ZipFile(part_file, 'w') as part:
+        _worker_processor._rewrite_member(_worker_zip, info, part)
+    return part_name
+
 
 class ZipProcessor:
     """
@@ -11,6 +115,10 @@ class ZipProcessor:
     1. Unzip files from the given ZIP file.
     2. Process the files (user defined function).
     3. Zip the processes files overwriting the original ZIP file.
+
+    Alternatively, stream_zip() passes each member of the ZIP file straight
+    into a new ZIP file through process_member() (user defined function),
+    without extracting anything to the file system.
     """
 
     def __init__(self, zipname):
@@ -35,3 +143,140 @@ class ZipProcessor:
             for filename in self.temp_directory.iterdir():
                 file.write(str(filename), filename.name)
         shutil.rmtree(str(self.temp_directory))
+
+    def stream_zip(self, workers=1, max_in_flight=None):
+        """
+        Process the members of the ZIP file one at a time, reading each from
+        the original ZIP file and writing it straight into a new one. The new
+        ZIP file is written next to the original and only replaces it once it
+        is complete, so if processing fails the original is left unchanged.
+        :param workers: Number of processes to process members in. With more
+        than one, the processor must be picklable.
+        :param max_in_flight: Maximum number of members being processed or
+        waiting to be added to the new ZIP file, when using several
+        processes. Defaults to twice the number of workers.
+        """
+        directory = os.path.dirname(os.path.abspath(self.zipname))
+        handle, temp_name = tempfile.mkstemp(suffix=".zip", dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                with zipfile.ZipFile(self.zipname) as source, \
+                        zipfile.ZipFile(temp_file, 'w') as target:
+                    target.comment = source.comment
+                    if workers > 1:
+                        self._stream_parallel(source, target, workers,
+                                              max_in_flight or 2 * workers,
+                                              directory)
+                    else:
+                        for info in source.infolist():
+                            self.stream_member(source, info, target)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            shutil.copymode(self.zipname, temp_name)
+            os.replace(temp_name, self.zipname)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+    def _stream_parallel(self, source, target, workers, max_in_flight,
+                         directory):
+        """
+        Process the members in a pool of worker processes. Each worker
+        decompresses, processes and recompresses a member into a temporary
+        ZIP file, whose compressed member is then copied into the target in
+        the original order. Only max_in_flight members are submitted at a
+        time, so neither the results waiting to be copied nor their temporary
+        files can build up.
+        """
+        with tempfile.TemporaryDirectory(dir=directory) as part_directory, \
+                ProcessPoolExecutor(workers, initializer=_init_worker,
+                                    initargs=(self,)) as pool:
+            pending = deque()
+            try:
+                for index, info in enumerate(source.infolist()):
+                    if len(pending) >= max_in_flight:
+                        self._copy_part(source, *pending.popleft(), target)
+                    pending.append((info, pool.submit(
+                        _process_in_worker, index, part_directory)))
+                while pending:
+                    self._copy_part(source, *pending.popleft(), target)
+            except BaseException:
+                for info, future in pending:
+                    future.cancel()
+                raise
+
+    @staticmethod
+    def _copy_part(source, info, future, target):
+        """
+        Copy the member processed by a worker into the target, from the
+        worker's ZIP file or, if it did not need to change, from the source.
+        """
+        part_name = future.result()
+        if part_name is None:
+            copy_raw_member(source, info, target)
+            return
+        with zipfile.ZipFile(part_name) as part:
+            copy_raw_member(part, part.infolist()[0], target)
+        os.remove(part_name)
+
+    def stream_member(self, source, info, target):
+        """
+        Pass one member of the source ZIP file through process_member() into
+        the target ZIP file. Members that needs_processing() shows will not
+        change are copied without being decompressed and recompressed.
+        :param source: ZipFile being read.
+        :param info: ZipInfo of the member in the source ZIP file.
+        :param target: ZipFile being written.
+        """
+        if self._is_unchanged(source, info):
+            copy_raw_member(source, info, target)
+        else:
+            self._rewrite_member(source, info, target)
+
+    def _is_unchanged(self, source, info):
+        """Return True if a member does not need to be processed."""
+        if info.is_dir():
+            return True
+        with source.open(info) as member:
+            return not self.needs_processing(info, member)
+
+    def _rewrite_member(self, source, info, target):
+        """
+        Write a member processed by process_member() into the target ZIP
+        file, keeping its name, date, attributes and compression method.
+        """
+        new_info = zipfile.ZipInfo(info.filename, info.date_time)
+        new_info.compress_type = info.compress_type
+        new_info.comment = info.comment
+        new_info.create_system = info.create_system
+        new_info.external_attr = info.external_attr
+        if info.is_dir():
+            target.writestr(new_info, b'')
+            return
+        # The size of the processed member is not known in advance, and even
+        # a small member can grow past the limit, so always allow for ZIP64
+        # sizes.
+        with source.open(info) as member, \
+                target.open(new_info, 'w', force_zip64=True) as output:
+            self.process_member(info, member, output)
+
+    def needs_processing(self, info, source):
+        """
+        Return False if process_member() would leave a member unchanged, so
+        that its compressed data can be copied as it is. This should be much
+        quicker than processing the member, e.g. a scan for the bytes that
+        would be replaced. The default implementation returns True.
+        :param info: ZipInfo of the member.
+        :param source: Binary file object to read the member's contents from.
+        """
+        return True
+
+    def process_member(self, info, source, target):
+        """
+        Process one member of the ZIP file for stream_zip(). The default
+        implementation copies it unchanged.
+        :param info: ZipInfo of the member.
+        :param source: Binary file object to read the member's contents from.
+        :param target: Binary file object to write the new contents to.
+        """
+        shutil.copyfileobj(source, target)
@@ -1,39 +1,345 @@
+import os
+import re
 import sys
+from collections import deque
+from collections.abc import Mapping
 
 from zip_processor import ZipProcessor
 
+# Number of bytes read at a time from each file or member.
+CHUNK_SIZE = 1 << 20
+
+
+def contains_stream(source, search, chunk_size=CHUNK_SIZE):
+    """
+    Return True if a binary file contains the search bytes, reading it a
+    chunk at a time.
+    :param source: Binary file object to read.
+    :param search: Non-empty bytes to search for.
+    :param chunk_size: Number of bytes to read at a time.
+    """
+    # Keep the end of each chunk in case the search bytes span two chunks.
+    overlap = len(search) - 1
+    tail = b""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return False
+        data = tail + chunk
+        if search in data:
+            return True
+        tail = data[-overlap:] if overlap else b""
+
+
+def replace_stream(source, target, search, replace, chunk_size=CHUNK_SIZE):
+    """
+    Copy a binary file, replacing every occurrence of the search bytes, a
+    chunk at a time. The last len(search) - 1 bytes of each chunk that are
+    not part of a match are carried over to the next chunk, in case a match
+    starts there, so the memory used does not depend on the size of the file.
+    The result is the same as bytes.replace() on the whole file.
+    :param source: Binary file object to read.
+    :param target: Binary file object to write.
+    :param search: Non-empty bytes to search for.
+    :param replace: Bytes to replace them with.
+    :param chunk_size: Number of bytes to read at a time.
+    :return: Number of replacements made.
+    """
+    if not search:
+        raise ValueError("The search string must not be empty")
+    length = len(search)
+    overlap = length - 1
+    count = 0
+    carry = b""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            # The carried bytes are too short to hold a match.
+            target.write(carry)
+            return count
+        data = carry + chunk
+        parts = []
+        position = 0
+        while True:
+            match = data.find(search, position)
+            if match < 0:
+                break
+            parts.append(data[position:match])
+            parts.append(replace)
+            position = match + length
+            count += 1
+        # A match could still start in the last overlap bytes.
+        keep = max(position, len(data) - overlap)
+        parts.append(data[position:keep])
+        target.write(b"".join(parts))
+        carry = data[keep:]
+
+
+class MultiReplacer:
+    """
+    Replaces many search strings in one pass over a file, using an
+    Aho-Corasick automaton: a trie of the search strings in which each state
+    also has a failure link to the state for the longest proper suffix of its
+    string that is in the trie, so the text never has to be read again when a
+    partial match fails.
+
+    Where matches overlap, the one that starts first is replaced and, of
+    those starting at the same place, the longest. For example with the
+    search strings "he", "hers" and "she", "ushers" has "she" replaced,
+    leaving "u", the replacement and "rs".
+    """
+
+    def __init__(self, replacements):
+        """
+        Build the automaton.
+        :param replacements: Mapping of non-empty search bytes to their
+        replacement bytes.
+        """
+        self.replacements = dict(replacements)
+        if not all(self.replacements):
+            raise ValueError("The search strings must not be empty")
+        # Transitions of each state by byte, and the length of its string.
+        self._goto = [{}]
+        self._depth = [0]
+        # Search string spelled by each state, if any.
+        terminal = [None]
+        for search in self.replacements:
+            state = 0
+            for byte in search:
+                next_state = self._goto[state].get(byte)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._depth.append(self._depth[state] + 1)
+                    terminal.append(None)
+                    self._goto[state][byte] = next_state
+                state = next_state
+            terminal[state] = search
+
+        # Failure link of each state, and the longest search string that is a
+        # suffix of its string, computed in breadth first order so that the
+        # shorter states they refer to are already done.
+        self._fail = [0] * len(self._goto)
+        self._match = list(terminal)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and byte not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(byte, 0)
+                if self._match[next_state] is None:
+                    self._match[next_state] = \
+                        self._match[self._fail[next_state]]
+                queue.append(next_state)
+
+        # Finds the next byte that can start a match, to skip over the text
+        # between matches without stepping through the automaton.
+        self._first_bytes = re.compile(
+            b"[" + b"".join(re.escape(bytes([byte]))
+                            for byte in sorted(self._goto[0])) + b"]"
+            if self._goto[0] else b"(?!)")
+
+    def _step(self, state, byte):
+        """
+        Return the state after reading a byte. Transitions found by following
+        failure links are remembered, so that each is only worked out once.
+        """
+        transitions = self._goto[state]
+        next_state = transitions.get(byte)
+        if next_state is None:
+            fail = state
+            while fail and byte not in self._goto[fail]:
+                fail = self._fail[fail]
+            next_state = transitions[byte] = self._goto[fail].get(byte, 0)
+        return next_state
+
+    def contains(self, source, chunk_size=CHUNK_SIZE):
+        """Return True if a binary file contains any of the search strings."""
+        state = 0
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                return False
+            position = 0
+            while position < len(data):
+                if not state:
+                    first = self._first_bytes.search(data, position)
+                    if first is None:
+                        break
+                    position = first.start()
+                state = self._step(state, data[position])
+                position += 1
+                if self._match[state] is not None:
+                    return True
+
+    def replace_stream(self, source, target, chunk_size=CHUNK_SIZE):
+        """
+        Copy a binary file, replacing the search strings, a chunk at a time.
+        Bytes are only held back while they could still be part of a match,
+        so the memory used does not depend on the size of the file.
+        :param source: Binary file object to read.
+        :param target: Binary file object to write.
+        :param chunk_size: Number of bytes to read at a time.
+        :return: Number of replacements made.
+        """
+        count = 0
+        # Bytes read but not yet written, the position of the next byte to
+        # pass through the automaton, and the best match found so far, as
+        # (start, end, search string), waiting to see if a match starting
+        # earlier or a longer one starting at the same place follows.
+        data = b""
+        scan = 0
+        state = 0
+        candidate = None
+        goto, depth, match = self._goto, self._depth, self._match
+        while True:
+            chunk = source.read(chunk_size)
+            final = not chunk
+            data += chunk
+            parts = []
+            written = 0
+            while True:
+                # A match can only start in the last depth bytes read, so
+                # the candidate is the best once it starts before them, or
+                # when there is nothing left to read.
+                if candidate is not None and (
+                        scan - depth[state] > candidate[0] or
+                        final and scan == len(data)):
+                    start, end, search = candidate
+                    parts.append(data[written:start])
+                    parts.append(self.replacements[search])
+                    count += 1
+                    # Look for the next match after this one.
+                    written = scan = end
+                    state = 0
+                    candidate = None
+                    continue
+                if scan == len(data):
+                    break
+                if not state:
+                    first = self._first_bytes.search(data, scan)
+                    if first is None:
+                        scan = len(data)
+                        continue
+                    scan = first.start()
+                byte = data[scan]
+                next_state = goto[state].get(byte)
+                state = self._step(state, byte) if next_state is None \
+                    else next_state
+                scan += 1
+                search = match[state]
+                if search is not None:
+                    start = scan - len(search)
+                    if candidate is None or start < candidate[0]:
+                        candidate = (start, scan, search)
+                    elif start == candidate[0] and scan > candidate[1]:
+                        candidate = (start, scan, search)
+            if final:
+                parts.append(data[written:])
+                target.write(b"".join(parts))
+                return count
+            # Write the bytes that can no longer be part of a match.
+            keep = scan - depth[state]
+            if candidate is not None:
+                keep = min(keep, candidate[0])
+            parts.append(data[written:keep])
+            target.write(b"".join(parts))
+            data = data[keep:]
+            scan -= keep
+            if candidate is not None:
+                start, end, search = candidate
+                candidate = (start - keep, end - keep, search)
+
 
 class ZipReplace(ZipProcessor):
     """
     Class used to perform a find and replace action for text files stored in a
     compressed ZIP file. This class is responsible for performing the find and
     replace action.
+
+    The files are processed as bytes a chunk at a time, so files of any size
+    can be processed in a fixed amount of memory. Many search strings can be
+    replaced in one pass over the files with a MultiReplacer.
     """
 
-    def __init__(self, filename, search_string, replace_string):
+    def __init__(self, filename, search_string, replace_string=None,
+                 encoding="utf8"):
         """
         The class is initialised with the ZIP filename and search and replace
         strings.
         :param filename: ZIP filename
-        :param search_string: String to search for in the files.
-        :param replace_string: Replacement string.
+        :param search_string: String to search for in the files, or a mapping
+        of search strings to replacement strings to replace all at once.
+        :param replace_string: Replacement string, if a single search string
+        is given.
+        :param encoding: Encoding of the files. Matches are found in the
+        encoded bytes, so it must be an encoding like UTF-8 or a single byte
+        encoding, in which the encoded search string cannot match part way
+        through a character. Bytes search and replace strings are used as
+        they are.
         """
         super(ZipReplace, self).__init__(filename)
         self.search_string = search_string
         self.replace_string = replace_string
+        self.encoding = encoding
+        if isinstance(search_string, Mapping):
+            if replace_string is not None:
+                raise TypeError("A replace string cannot be given with a "
+                                "mapping of replacements")
+            self.replacer = MultiReplacer(
+                {self._encode(search): self._encode(replace)
+                 for search, replace in search_string.items()})
+            return
+        if replace_string is None:
+            raise TypeError("A replace string is needed")
+        self.replacer = None
+        self.search_bytes = self._encode(search_string)
+        self.replace_bytes = self._encode(replace_string)
+        if not self.search_bytes:
+            raise ValueError("The search string must not be empty")
+
+    def _encode(self, string):
+        """Encode a search or replace string in the files' encoding."""
+        if isinstance(string, bytes):
+            return string
+        return string.encode(self.encoding)
 
     def process_files(self):
         """
         Find and replace the strings in all of the files in the temporary
-        directory.
+        directory. Each file is rewritten into a new file that then replaces
+        it.
+        """
+        for filename in list(self.temp_directory.iterdir()):
+            new_filename = filename.with_name(filename.name + ".new")
+            with filename.open("rb") as source, \
+                    new_filename.open("wb") as target:
+                self._replace(source, target)
+            os.replace(str(new_filename), str(filename))
+
+    def _replace(self, source, target):
+        """Copy a binary file, replacing the search strings."""
+        if self.replacer is not None:
+            self.replacer.replace_stream(source, target)
+        else:
+            replace_stream(source, target, self.search_bytes,
+                           self.replace_bytes)
+
+    def needs_processing(self, info, source):
         """
-        for filename in self.temp_directory.iterdir():
-            with filename.open() as file:
-                contents = file.read()
-            contents = contents.replace(self.search_string, self.replace_string)
-            with filename.open("w") as file:
-                file.write(contents)
+        Scan a member for the search string, so that members that do not
+        contain it are copied as they are.
+        """
+        if self.replacer is not None:
+            return self.replacer.contains(source)
+        return contains_stream(source, self.search_bytes)
+
+    def process_member(self, info, source, target):
+        """Find and replace the strings in one member of the ZIP file."""
+        self._replace(source, target)
 
 
 if __name__ == "__main__":
-    ZipReplace(*sys.argv[1:4]).process_zip()
+    ZipReplace(*sys.argv[1:5]).stream_zip()
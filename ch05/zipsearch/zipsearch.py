@@ -1,8 +1,56 @@
+import os
 import sys
 import shutil
 import zipfile
 from pathlib import Path
 
+# Number of bytes read at a time from each file.
+CHUNK_SIZE = 1 << 20
+
+
+def replace_stream(source, target, search, replace, chunk_size=CHUNK_SIZE):
+    """
+    Copy a binary file, replacing every occurrence of the search bytes, a
+    chunk at a time. The last len(search) - 1 bytes of each chunk that are
+    not part of a match are carried over to the next chunk, in case a match
+    starts there, so the memory used does not depend on the size of the file.
+    The result is the same as bytes.replace() on the whole file.
+    :param source: Binary file object to read.
+    :param target: Binary file object to write.
+    :param search: Non-empty bytes to search for.
+    :param replace: Bytes to replace them with.
+    :param chunk_size: Number of bytes to read at a time.
+    :return: Number of replacements made.
+    """
+    if not search:
+        raise ValueError("The search string must not be empty")
+    length = len(search)
+    overlap = length - 1
+    count = 0
+    carry = b""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            # The carried bytes are too short to hold a match.
+            target.write(carry)
+            return count
+        data = carry + chunk
+        parts = []
+        position = 0
+        while True:
+            match = data.find(search, position)
+            if match < 0:
+                break
+            parts.append(data[position:match])
+            parts.append(replace)
+            position = match + length
+            count += 1
+        # A match could still start in the last overlap bytes.
+        keep = max(position, len(data) - overlap)
+        parts.append(data[position:keep])
+        target.write(b"".join(parts))
+        carry = data[keep:]
+
 
 class ZipReplace:
     """
@@ -13,17 +61,25 @@ class ZipReplace:
         3. Zipping up the new files.
     """
 
-    def __init__(self, filename, search_string, replace_string):
+    def __init__(self, filename, search_string, replace_string,
+                 encoding="utf8"):
         """
         The class is initialised with the ZIP filename and search and replace
         strings.
         :param filename: ZIP filename
         :param search_string: String to search for in the files.
         :param replace_string: Replacement string.
+        :param encoding: Encoding of the files. Matches are found in the
+        encoded bytes, so it must be an encoding like UTF-8 or a single byte
+        encoding, in which the encoded search string cannot match part way
+        through a character.
         """
         self.filename = filename
         self.search_string = search_string
         self.replace_string = replace_string
+        self.encoding = encoding
+        if not search_string:
+            raise ValueError("The search string must not be empty")
         # A temporary directory is used to store the unzipped files during
         # processing for search & replace.
         self.temp_directory = Path("unzipped-{}".format(filename))
@@ -44,13 +100,20 @@ class ZipReplace:
             zip.extractall(str(self.temp_directory))
 
     def find_replace(self):
-        """Find and replace the strings in all of the files in the directory."""
-        for filename in self.temp_directory.iterdir():
-            with filename.open() as file:
-                contents = file.read()
-            contents = contents.replace(self.search_string, self.replace_string)
-            with filename.open("w") as file:
-                file.write(contents)
+        """
+        Find and replace the strings in all of the files in the directory.
+        Each file is rewritten a chunk at a time into a new file that then
+        replaces it, so files of any size can be processed in a fixed amount
+        of memory.
+        """
+        search = self.search_string.encode(self.encoding)
+        replace = self.replace_string.encode(self.encoding)
+        for filename in list(self.temp_directory.iterdir()):
+            new_filename = filename.with_name(filename.name + ".new")
+            with filename.open("rb") as source, \
+                    new_filename.open("wb") as target:
+                replace_stream(source, target, search, replace)
+            os.replace(str(new_filename), str(filename))
 
     def zip_files(self):
         """Zip (compress) the files in the directory."""
@@ -61,4 +124,4 @@ class ZipReplace:
 
 
 if __name__ == "__main__":
-    ZipReplace(*sys.argv[1:4]).zip_find_replace()
+    ZipReplace(*sys.argv[1:5]).zip_find_replace()
@@ -0,0 +1,507 @@
+import argparse
+import mmap
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from case_study_ml import (MODEL_MAGIC, TABLE_SIZE, ColourTable,
+                           compile_colours, generate_colours, load_colours,
+                           model_digest, process_colours, read_model_header,
+                           write_colour_table, write_result_batches)
+
+# Batch mode for the k-nearest neighbour colour classifier in case_study_ml.
+# Instead of pushing one colour at a time through the chain of coroutines, an
+# N x 3 array of target colours is classified in one call. The distances to the
+# model are computed for a chunk of targets at a time using NumPy broadcasting,
+# and the chunk size is chosen so that the working memory stays below a limit.
+
+# Default ceiling, in bytes, on the working memory used by one chunk.
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Default number of target colours sent to a worker process at a time.
+DEFAULT_BATCH_SIZE = 10000
+
+# Binary results file format written by write_results_binary():
+#   header       magic and size of the label table
+#   label table  UTF-8 label names separated by newlines
+#   blocks       one per chunk of results: the number of colours n, then the
+#                red, green and blue channels as float32 columns of n values
+#                and n uint8 label ids
+RESULTS_MAGIC = b'KNNR'
+_results_header = struct.Struct('=4sI')
+_block_header = struct.Struct('=I')
+
+
+def model_arrays(model_colours):
+    """
+    Convert the ((r, g, b), colour_name) tuples returned by load_colours() into
+    arrays.
+    :param model_colours: iterable of ((r, g, b), colour_name) tuples.
+    :return: tuple of an M x 3 colour array, an array of M label ids and the
+    list of label names indexed by label id.
+    """
+    model = list(model_colours)
+    labels = sorted(set(name for colour, name in model))
+    label_ids = {name: i for i, name in enumerate(labels)}
+    colours = np.array([colour for colour, name in model], dtype=np.float64)
+    ids = np.array([label_ids[name] for colour, name in model], dtype=np.intp)
+    return colours.reshape(-1, 3), ids, labels
+
+
+def load_model_arrays(dataset_filename):
+    """
+    Load the model arrays from a colour CSV file or from a binary model file
+    written by case_study_ml.compile_colours(). A compiled model is memory
+    mapped: the float32 colour columns and uint8 label ids are used in place
+    without parsing or copying.
+    :param dataset_filename: colour CSV file or compiled model file.
+    :return: tuple of an M x 3 colour array, an array of M label ids and the
+    list of label names indexed by label id.
+    """
+    with open(dataset_filename, 'rb') as dataset_file:
+        if dataset_file.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            return model_arrays(load_colours(dataset_filename))
+        data = mmap.mmap(dataset_file.fileno(), 0, access=mmap.ACCESS_READ)
+    count, labels, offset = read_model_header(data)
+    # The red, green and blue columns are stored one after the other, so they
+    # form a 3 x M array whose transpose is the M x 3 colour array.
+    columns = np.frombuffer(data, dtype=np.float32, count=3 * count,
+                            offset=offset).reshape(3, count)
+    label_ids = np.frombuffer(data, dtype=np.uint8, count=count,
+                              offset=offset + columns.nbytes)
+    return columns.T, label_ids, labels
+
+
+class BatchClassifier:
+    """
+    Vectorised k-nearest neighbour classifier. Classifies whole arrays of
+    target colours against a model held in NumPy arrays.
+    """
+
+    def __init__(self, colours, label_ids, labels, num_neighbours=5,
+                 memory_limit=DEFAULT_MEMORY_LIMIT):
+        """
+        Create a classifier from the model arrays returned by model_arrays().
+        :param colours: M x 3 array of model colours.
+        :param label_ids: array of M label ids, one per model colour.
+        :param labels: list of label names indexed by label id.
+        :param num_neighbours: number of neighbours that vote on a name.
+        :param memory_limit: ceiling in bytes on the memory used per chunk.
+        """
+        if len(colours) == 0:
+            raise ValueError("The model does not contain any colours")
+        # Compiled models are kept in float32, anything else uses float64.
+        colours = np.asarray(colours)
+        dtype = np.float32 if colours.dtype == np.float32 else np.float64
+        self.colours = colours.astype(dtype, copy=False)
+        self.label_ids = np.asarray(label_ids)
+        self.labels = list(labels)
+        self.num_neighbours = min(num_neighbours, len(self.colours))
+        self.memory_limit = memory_limit
+        # Squared length of each model colour; see _classify_chunk().
+        self.colours_squared = (self.colours ** 2).sum(axis=1)
+
+    @classmethod
+    def from_model_colours(cls, model_colours, **kwargs):
+        """Create a classifier from the output of load_colours()."""
+        return cls(*model_arrays(model_colours), **kwargs)
+
+    def chunk_size(self):
+        """Return the number of targets classified per chunk."""
+        # Each target in a chunk needs a row of distances and a row of intp
+        # indices from argpartition(), one per model colour.
+        row_bytes = ((self.colours.itemsize + np.dtype(np.intp).itemsize) *
+                     len(self.colours))
+        return max(1, self.memory_limit // row_bytes)
+
+    def classify_ids(self, targets):
+        """
+        Classify the target colours.
+        :param targets: N x 3 array like of RGB target colours.
+        :return: array of N label ids.
+        """
+        targets = np.asarray(targets, dtype=self.colours.dtype).reshape(-1, 3)
+        result = np.empty(len(targets), dtype=np.intp)
+        step = self.chunk_size()
+        for start in range(0, len(targets), step):
+            chunk = targets[start:start + step]
+            result[start:start + len(chunk)] = self._classify_chunk(chunk)
+        return result
+
+    def classify(self, targets):
+        """
+        Classify the target colours.
+        :param targets: N x 3 array like of RGB target colours.
+        :return: list of N colour names.
+        """
+        return [self.labels[i] for i in self.classify_ids(targets)]
+
+    def _classify_chunk(self, chunk):
+        """Return the label ids voted for by the neighbours of each target."""
+        k = self.num_neighbours
+        rows = np.arange(len(chunk))
+        # |t - c|^2 = |t|^2 - 2 t.c + |c|^2. The |t|^2 term is the same for
+        # every model colour in a row so it does not change the ordering and
+        # is left out. This avoids a chunk x M x 3 array of differences.
+        distances = chunk @ self.colours.T
+        distances *= -2
+        distances += self.colours_squared
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        # argpartition() leaves the k nearest unordered, so sort them by
+        # distance to reproduce the tie breaking of name_colours().
+        order = np.argsort(distances[rows[:, np.newaxis], nearest], axis=1,
+                           kind='stable')
+        ids = self.label_ids[nearest[rows[:, np.newaxis], order]]
+        # Count the votes for every (target, label) pair with one bincount by
+        # giving each row its own range of label ids.
+        num_labels = len(self.labels)
+        votes = np.bincount(
+            (ids + rows[:, np.newaxis] * num_labels).ravel(),
+            minlength=len(chunk) * num_labels,
+        ).reshape(len(chunk), num_labels)
+        # Counter.most_common() breaks ties in favour of the label seen first,
+        # i.e. the label of the nearer neighbour.
+        first_seen = np.full_like(votes, k)
+        for rank in range(k - 1, -1, -1):
+            first_seen[rows, ids[:, rank]] = rank
+        return np.argmax(votes * (k + 1) - first_seen, axis=1)
+
+
+def write_label_batches(labels, filename='output.csv', buffer_size=1 << 20):
+    """
+    Coroutine that accepts (colours, label_ids) tuples of arrays and writes
+    them to a CSV file in the format of case_study_ml.write_results(), one
+    chunk at a time. The coroutine must be closed to flush the output.
+    :param labels: list of label names indexed by label id.
+    :param filename: output CSV file name.
+    :param buffer_size: size in bytes of the output buffer.
+    :return:
+    """
+    names = np.array(labels, dtype=object)
+    output = write_result_batches(filename, buffer_size)
+    next(output)
+    try:
+        while True:
+            colours, label_ids = yield
+            output.send((np.asarray(colours).tolist(),
+                         names[label_ids].tolist()))
+    finally:
+        output.close()
+
+
+def write_results_binary(labels, filename='output.knr', buffer_size=1 << 20):
+    """
+    Columnar binary alternative to write_label_batches(). Each chunk of
+    results is written as one block of float32 colour columns and uint8 label
+    ids, without formatting any numbers. The coroutine must be closed to flush
+    the output.
+    :param labels: list of label names indexed by label id.
+    :param filename: output results file name.
+    :param buffer_size: size in bytes of the output buffer.
+    :return:
+    """
+    if len(labels) > 256:
+        raise ValueError("A results file can have at most 256 labels")
+    table = '\n'.join(labels).encode('utf8')
+    with open(filename, 'wb', buffering=buffer_size) as file:
+        file.write(_results_header.pack(RESULTS_MAGIC, len(table)))
+        file.write(table)
+        while True:
+            colours, label_ids = yield
+            columns = np.ascontiguousarray(
+                np.asarray(colours, dtype=np.float32).reshape(-1, 3).T)
+            file.write(_block_header.pack(columns.shape[1]))
+            file.write(columns)
+            file.write(np.asarray(label_ids, dtype=np.uint8))
+
+
+def read_results_binary(filename):
+    """
+    Read a results file written by write_results_binary(). Implemented as a
+    generator which returns one tuple per block.
+    :param filename: results file name.
+    :return: tuple of an N x 3 colour array, N label ids and the list of label
+    names.
+    """
+    with open(filename, 'rb') as file:
+        magic, table_size = _results_header.unpack(
+            file.read(_results_header.size))
+        if magic != RESULTS_MAGIC:
+            raise ValueError("Not a colour results file")
+        table = file.read(table_size).decode('utf8')
+        labels = table.split('\n') if table else []
+        for header in iter(lambda: file.read(_block_header.size), b''):
+            count, = _block_header.unpack(header)
+            columns = np.fromfile(file, dtype=np.float32, count=3 * count)
+            label_ids = np.fromfile(file, dtype=np.uint8, count=count)
+            yield columns.reshape(3, count).T, label_ids, labels
+
+
+def _results_writer(labels, output_filename, binary):
+    """Start the writer coroutine selected by the binary flag."""
+    if binary:
+        output = write_results_binary(labels, output_filename)
+    else:
+        output = write_label_batches(labels, output_filename)
+    next(output)
+    return output
+
+
+def process_colours_batch(dataset_filename='colors.csv', count=100,
+                          num_neighbours=5, memory_limit=DEFAULT_MEMORY_LIMIT,
+                          output_filename='output.csv', binary=False):
+    """
+    Batch equivalent of case_study_ml.process_colours(). Generate random
+    colours, classify them in one call and write the results.
+    :param dataset_filename: training data set file of colours or compiled
+    model file.
+    :param count: number of random colours to classify.
+    :param num_neighbours: number of neighbours that vote on a name.
+    :param memory_limit: ceiling in bytes on the memory used per chunk.
+    :param output_filename: output results file name.
+    :param binary: write a binary results file instead of CSV.
+    :return: None
+    """
+    classifier = BatchClassifier(*load_model_arrays(dataset_filename),
+                                 num_neighbours=num_neighbours,
+                                 memory_limit=memory_limit)
+    targets = np.array(list(generate_colours(count))).reshape(-1, 3)
+    output = _results_writer(classifier.labels, output_filename, binary)
+    output.send((targets, classifier.classify_ids(targets)))
+    output.close()
+
+
+def share_model(colours, label_ids):
+    """
+    Copy the model arrays into a new shared memory block. The block holds the
+    M x 3 colours followed by the M intp label ids.
+    :param colours: M x 3 array of model colours.
+    :param label_ids: array of M label ids.
+    :return: the SharedMemory block; the caller must close() and unlink() it.
+    """
+    colours = np.asarray(colours)
+    label_ids = np.asarray(label_ids, dtype=np.intp)
+    block = shared_memory.SharedMemory(
+        create=True, size=max(1, colours.nbytes + label_ids.nbytes))
+    shared_colours, shared_ids = _shared_model_arrays(block, len(colours),
+                                                      colours.dtype)
+    shared_colours[:] = colours
+    shared_ids[:] = label_ids
+    return block
+
+
+def _shared_model_arrays(block, num_colours, dtype):
+    """Return the colour and label id arrays stored in a shared memory block."""
+    colours = np.ndarray((num_colours, 3), dtype=dtype, buffer=block.buf)
+    label_ids = np.ndarray((num_colours,), dtype=np.intp, buffer=block.buf,
+                           offset=colours.nbytes)
+    return colours, label_ids
+
+
+# State of a worker process, set up once by _init_worker().
+_worker_block = None
+_worker_classifier = None
+
+
+def _init_worker(block_name, num_colours, dtype, labels, num_neighbours,
+                 memory_limit):
+    """
+    Process pool initialiser. Attach to the shared model and build the worker's
+    classifier over it, without copying the model arrays.
+    """
+    global _worker_block, _worker_classifier
+    # The block must stay referenced for as long as the arrays are in use.
+    _worker_block = shared_memory.SharedMemory(name=block_name)
+    colours, label_ids = _shared_model_arrays(_worker_block, num_colours,
+                                              dtype)
+    _worker_classifier = BatchClassifier(colours, label_ids, labels,
+                                         num_neighbours, memory_limit)
+
+
+def _classify_in_worker(targets):
+    """Classify a batch of targets in a worker process."""
+    return _worker_classifier.classify_ids(targets)
+
+
+def _classify_table_slab(red):
+    """
+    Classify the 256 x 256 colours with the given red value in a worker
+    process, in lookup table order.
+    """
+    green, blue = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    targets = np.column_stack((np.full(green.size, red), green.ravel(),
+                               blue.ravel())) / 255
+    return _worker_classifier.classify_ids(targets).astype(np.uint8)
+
+
+@contextmanager
+def _shared_model_pool(colours, label_ids, labels, workers, num_neighbours,
+                       memory_limit):
+    """
+    Context manager yielding a process pool whose workers classify against
+    the model arrays, which are shared with them through shared memory.
+    """
+    block = share_model(colours, label_ids)
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(block.name, len(colours), colours.dtype.str,
+                          labels, num_neighbours, memory_limit)) as executor:
+            yield executor
+    finally:
+        block.close()
+        block.unlink()
+
+
+def process_colours_parallel(dataset_filename='colors.csv', count=100,
+                             workers=4, batch_size=DEFAULT_BATCH_SIZE,
+                             num_neighbours=5,
+                             memory_limit=DEFAULT_MEMORY_LIMIT,
+                             output_filename='output.csv', binary=False):
+    """
+    Multi-process equivalent of process_colours_batch(). The model is loaded
+    once into shared memory and batches of targets are classified by a pool
+    of worker processes. Results are written in the order of the targets.
+    :param dataset_filename: training data set file of colours or compiled
+    model file.
+    :param count: number of random colours to classify.
+    :param workers: number of worker processes.
+    :param batch_size: number of targets sent to a worker at a time.
+    :param num_neighbours: number of neighbours that vote on a name.
+    :param memory_limit: ceiling in bytes on the memory used per chunk in each
+    worker.
+    :param output_filename: output results file name.
+    :param binary: write a binary results file instead of CSV.
+    :return: None
+    """
+    colours, label_ids, labels = load_model_arrays(dataset_filename)
+    with _shared_model_pool(colours, label_ids, labels, workers,
+                            num_neighbours, memory_limit) as executor:
+        output = _results_writer(labels, output_filename, binary)
+        target_colours = generate_colours(count)
+        # Keep a bounded number of batches in flight so that the targets are
+        # not all generated up front. The oldest batch is always written
+        # first, which keeps the output in input order.
+        pending = deque()
+        while True:
+            targets = np.array(list(islice(target_colours, batch_size)))
+            if len(targets):
+                pending.append((targets, executor.submit(_classify_in_worker,
+                                                         targets)))
+            if pending and (len(pending) > 2 * workers or not len(targets)):
+                targets, future = pending.popleft()
+                output.send((targets, future.result()))
+            elif not pending:
+                break
+        output.close()
+
+
+def build_colour_table(dataset_filename, table_filename, workers=4,
+                       num_neighbours=5, memory_limit=DEFAULT_MEMORY_LIMIT):
+    """
+    Name every colour with 8 bits per channel and write the names to a lookup
+    table file for case_study_ml.ColourTable. The colours are named with the
+    same neighbour vote as name_colours(), one slab of equal red values per
+    task on a pool of worker processes.
+    :param dataset_filename: training data set file of colours or compiled
+    model file.
+    :param table_filename: output lookup table file.
+    :param workers: number of worker processes.
+    :param num_neighbours: number of neighbours that vote on a name.
+    :param memory_limit: ceiling in bytes on the memory used per chunk in each
+    worker.
+    :return: None
+    """
+    colours, label_ids, labels = load_model_arrays(dataset_filename)
+    if len(labels) > 256:
+        raise ValueError("A colour table can have at most 256 labels")
+    table = np.empty(TABLE_SIZE, dtype=np.uint8)
+    with _shared_model_pool(colours, label_ids, labels, workers,
+                            num_neighbours, memory_limit) as executor:
+        for red, slab in enumerate(executor.map(_classify_table_slab,
+                                                range(256))):
+            table[red << 16:(red + 1) << 16] = slab
+    write_colour_table(table_filename, table, labels,
+                       model_digest(dataset_filename), num_neighbours)
+
+
+def open_colour_table(dataset_filename, table_filename, workers=4,
+                      num_neighbours=5):
+    """
+    Open a colour lookup table, building it first if it does not exist or is
+    stale because the model file has changed.
+    :param dataset_filename: training data set file of colours or compiled
+    model file.
+    :param table_filename: lookup table file.
+    :param workers: number of worker processes used to build the table.
+    :param num_neighbours: number of neighbours that vote on a name.
+    :return: ColourTable
+    """
+    try:
+        table = ColourTable(table_filename)
+    except (OSError, ValueError):
+        table = None
+    if table is None or table.is_stale(dataset_filename, num_neighbours):
+        build_colour_table(dataset_filename, table_filename, workers,
+                           num_neighbours)
+        table = ColourTable(table_filename)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Name random colours using the k-nearest neighbour '
+                    'classifier.')
+    parser.add_argument('--dataset', default='colors.csv',
+                        help='training data set file of colours or compiled '
+                             'model file')
+    parser.add_argument('--compile', metavar='MODEL',
+                        help='compile the data set into a binary model file '
+                             'and exit')
+    parser.add_argument('--build-table', metavar='TABLE',
+                        help='build a lookup table of the names of all 8 bit '
+                             'RGB colours and exit')
+    parser.add_argument('--table', metavar='TABLE',
+                        help='name the colours from a lookup table, which is '
+                             'rebuilt if the data set has changed')
+    parser.add_argument('--output', default='output.csv',
+                        help='output results file')
+    parser.add_argument('--binary', action='store_true',
+                        help='write a columnar binary results file instead '
+                             'of CSV')
+    parser.add_argument('--count', type=int, default=100,
+                        help='number of random colours to classify')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of colours sent to a worker at a time')
+    args = parser.parse_args()
+    if args.compile:
+        compile_colours(args.dataset, args.compile)
+    elif args.build_table:
+        build_colour_table(args.dataset, args.build_table,
+                           max(args.workers, 1))
+    elif args.table:
+        if args.binary:
+            parser.error('--binary cannot be used with --table')
+        table = open_colour_table(args.dataset, args.table,
+                                  max(args.workers, 1))
+        process_colours(table=table, count=args.count,
+                        output_filename=args.output)
+    elif args.workers > 1:
+        process_colours_parallel(args.dataset, args.count, args.workers,
+                                 args.batch_size,
+                                 output_filename=args.output,
+                                 binary=args.binary)
+    else:
+        process_colours_batch(args.dataset, args.count,
+                              output_filename=args.output, binary=args.binary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+from case_study_batch import (BatchClassifier, load_model_arrays,
+                              write_label_batches)
+from case_study_ml import (BallTree, KDTree, NeighbourIndex, load_colours,
+                           write_result_batches)
+
+# Throughput benchmark for the k-nearest neighbour colour classifier in
+# case_study_ml and case_study_batch. A synthetic training set and stream of
+# target colours are generated from fixed seeds, then the load, index build,
+# query and write stages are timed separately. The results are reported as
+# JSON so that they can be compared between versions.
+
+# Anchor colours used to label the synthetic training set; each training
+# colour is named after the nearest anchor.
+ANCHOR_COLOURS = {
+    'Red': (1.0, 0.0, 0.0),
+    'Orange': (1.0, 0.5, 0.0),
+    'Yellow': (1.0, 1.0, 0.0),
+    'Green': (0.0, 0.8, 0.0),
+    'Blue': (0.0, 0.0, 1.0),
+    'Purple': (0.5, 0.0, 0.5),
+    'Pink': (1.0, 0.6, 0.7),
+    'Grey': (0.5, 0.5, 0.5),
+    'White': (1.0, 1.0, 1.0),
+}
+
+# Neighbour search backends that can be benchmarked.
+BACKENDS = {
+    'brute': NeighbourIndex,
+    'kdtree': KDTree,
+    'balltree': BallTree,
+    'batch': BatchClassifier,
+}
+
+
+def write_training_set(filename, size, seed):
+    """
+    Write a synthetic training set in the format of colors.csv.
+    :param filename: output CSV file name.
+    :param size: number of labelled colours.
+    :param seed: random seed.
+    :return: None
+    """
+    rng = random.Random(seed)
+    with open(filename, 'w') as file:
+        for i in range(size):
+            colour = (rng.random(), rng.random(), rng.random())
+            name = min(ANCHOR_COLOURS, key=lambda n: sum(
+                (c - a) ** 2 for c, a in zip(colour, ANCHOR_COLOURS[n])))
+            file.write('{},{},{},{}\n'.format(*colour, name))
+
+
+def generate_targets(count, seed):
+    """Return a list of count random target colours."""
+    rng = random.Random(seed)
+    return [(rng.random(), rng.random(), rng.random()) for i in range(count)]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return usage if platform.system() == 'Darwin' else usage * 1024
+
+
+class Stages:
+    """Record the elapsed time and throughput of each benchmark stage."""
+
+    def __init__(self):
+        self.results = {}
+
+    def time(self, name, items, func, *args):
+        """
+        Call func(*args) and record it as the named stage. The peak resident
+        set size only ever rises, so each stage records how far it raised the
+        peak, which is 0 for a stage that used no more memory than an earlier
+        one.
+        :param name: stage name.
+        :param items: number of items processed by the stage.
+        :return: the value returned by func.
+        """
+        peak_before = peak_rss()
+        start = time.perf_counter()
+        value = func(*args)
+        elapsed = time.perf_counter() - start
+        self.results[name] = {
+            'seconds': elapsed,
+            'items': items,
+            'items_per_second': items / elapsed if elapsed else None,
+            'peak_rss_increase_bytes': peak_rss() - peak_before,
+        }
+        return value
+
+
+def bench_coroutine_backend(stages, index_type, dataset_filename,
+                            output_filename, model_size, targets,
+                            num_neighbours):
+    """Benchmark a NeighbourIndex backend of case_study_ml."""
+    model = stages.time('load', model_size, list,
+                        load_colours(dataset_filename))
+    index = stages.time('build', model_size, index_type, model)
+
+    def query():
+        # The same vote as case_study_ml.name_colours().
+        return [Counter(n[1] for n in index.query(target, num_neighbours))
+                .most_common(1)[0][0] for target in targets]
+
+    names = stages.time('query', len(targets), query)
+
+    def write():
+        output = write_result_batches(output_filename)
+        next(output)
+        output.send((targets, names))
+        output.close()
+
+    stages.time('write', len(targets), write)
+
+
+def bench_batch_backend(stages, dataset_filename, output_filename, model_size,
+                        targets, num_neighbours):
+    """Benchmark the BatchClassifier of case_study_batch."""
+    colours, label_ids, labels = stages.time('load', model_size,
+                                             load_model_arrays,
+                                             dataset_filename)
+    classifier = stages.time('build', model_size, BatchClassifier, colours,
+                             label_ids, labels, num_neighbours)
+    targets = np.array(targets)
+    ids = stages.time('query', len(targets), classifier.classify_ids,
+                      targets)
+
+    def write():
+        output = write_label_batches(labels, output_filename)
+        next(output)
+        output.send((targets, ids))
+        output.close()
+
+    stages.time('write', len(targets), write)
+
+
+def run_benchmark(backend='kdtree', model_size=10000, target_count=10000,
+                  num_neighbours=5, seed=0):
+    """
+    Run the benchmark for one backend.
+    :param backend: name of the backend in BACKENDS.
+    :param model_size: number of colours in the synthetic training set.
+    :param target_count: number of target colours to name.
+    :param num_neighbours: number of neighbours that vote on a name.
+    :param seed: random seed for the training set; the targets use seed + 1.
+    :return: dictionary of the benchmark configuration and stage results.
+    """
+    stages = Stages()
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_filename = os.path.join(directory, 'colours.csv')
+        output_filename = os.path.join(directory, 'output.csv')
+        stages.time('generate', model_size, write_training_set,
+                    dataset_filename, model_size, seed)
+        targets = generate_targets(target_count, seed + 1)
+        if backend == 'batch':
+            bench_batch_backend(stages, dataset_filename, output_filename,
+                                model_size, targets, num_neighbours)
+        else:
+            bench_coroutine_backend(stages, BACKENDS[backend],
+                                    dataset_filename, output_filename,
+                                    model_size, targets, num_neighbours)
+    return {
+        'backend': backend,
+        'model_size': model_size,
+        'target_count': target_count,
+        'num_neighbours': num_neighbours,
+        'seed': seed,
+        'python': platform.python_version(),
+        'stages': stages.results,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the k-nearest neighbour colour classifier.')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='kdtree', help='neighbour search backend')
+    parser.add_argument('--model-size', type=int, default=10000,
+                        help='number of colours in the training set')
+    parser.add_argument('--targets', type=int, default=10000,
+                        help='number of target colours to name')
+    parser.add_argument('--neighbours', type=int, default=5,
+                        help='number of neighbours that vote on a name')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='write the JSON results to a file '
+                                         'instead of standard output')
+    args = parser.parse_args()
+    results = run_benchmark(args.backend, args.model_size, args.targets,
+                            args.neighbours, args.seed)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
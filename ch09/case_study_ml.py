@@ -1,7 +1,14 @@
 import csv
+from array import array
 from random import random
+import hashlib
+import heapq
 import math
-from collections import Counter
+import mmap
+import struct
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict
 
 # This is a machine learning case study in which a program is given an RGB
 # colour definition from which it has to name the colour as a human would
@@ -13,6 +20,26 @@ from collections import Counter
 
 dataset_filename = 'colors.csv'
 
+# Compiled (binary) model file format written by compile_colours():
+#   header       magic, number of colours and size of the label table
+#   label table  UTF-8 label names separated by newlines, padded to 4 bytes
+#   columns      red, green and blue channels as float32 arrays
+#   label ids    uint8 index into the label table for each colour
+# Numbers are stored in native byte order so the columns can be used directly
+# from a memory map.
+MODEL_MAGIC = b'KNNM'
+_model_header = struct.Struct('=4sII')
+
+# Colour lookup table file format written by write_colour_table():
+#   header       magic, SHA-256 digest of the model file, number of neighbours
+#                and size of the label table
+#   label table  UTF-8 label names separated by newlines
+#   label ids    uint8 label id for each of the 2 ** 24 colours with 8 bits
+#                per channel, indexed by (red << 16) | (green << 8) | blue
+TABLE_MAGIC = b'KNNT'
+TABLE_SIZE = 1 << 24
+_table_header = struct.Struct('=4s32sII')
+
 
 def load_colours(filename):
     """
@@ -37,6 +64,86 @@ def load_colours(filename):
 #     print('RGB {} is named {}'.format(colour, name))
 
 
+def compile_colours(filename, model_filename):
+    """
+    Compile the colours in the CSV file into a binary model file that can be
+    memory mapped by map_colours() without parsing.
+    :param filename: input colour CSV file.
+    :param model_filename: output binary model file.
+    :return: number of colours written.
+    """
+    columns = (array('f'), array('f'), array('f'))
+    label_ids = array('B')
+    labels = {}
+    for colour, name in load_colours(filename):
+        for column, value in zip(columns, colour):
+            column.append(value)
+        if name not in labels:
+            if len(labels) > 255:
+                raise ValueError("A model can have at most 256 labels")
+            labels[name] = len(labels)
+        label_ids.append(labels[name])
+    table = '\n'.join(labels).encode('utf8')
+    table += b'\0' * (-len(table) % 4)
+    with open(model_filename, 'wb') as model_file:
+        model_file.write(_model_header.pack(MODEL_MAGIC, len(label_ids),
+                                            len(table)))
+        model_file.write(table)
+        for column in columns:
+            column.tofile(model_file)
+        label_ids.tofile(model_file)
+    return len(label_ids)
+
+
+def read_model_header(data):
+    """
+    Read the header and label table of a compiled model.
+    :param data: buffer holding the compiled model, e.g. a memory map.
+    :return: tuple of the number of colours, list of label names and offset of
+    the colour columns in the buffer.
+    """
+    magic, count, table_size = _model_header.unpack_from(data)
+    if magic != MODEL_MAGIC:
+        raise ValueError("Not a compiled colour model")
+    offset = _model_header.size
+    table = bytes(data[offset:offset + table_size]).rstrip(b'\0')
+    labels = table.decode('utf8').split('\n') if table else []
+    return count, labels, offset + table_size
+
+
+def map_colours(model_filename):
+    """
+    Memory map a compiled model file. Nothing is parsed apart from the label
+    table; the columns are views onto the mapped file.
+    :param model_filename: binary model file written by compile_colours().
+    :return: tuple of the red, green and blue float32 columns, the uint8 label
+    ids and the list of label names.
+    """
+    with open(model_filename, 'rb') as model_file:
+        data = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+    count, labels, offset = read_model_header(data)
+    view = memoryview(data)
+    column_size = 4 * count
+    columns = tuple(
+        view[offset + i * column_size:offset + (i + 1) * column_size].cast('f')
+        for i in range(3)
+    )
+    offset += 3 * column_size
+    return columns + (view[offset:offset + count], labels)
+
+
+def load_colours_binary(model_filename):
+    """
+    Equivalent of load_colours() for a compiled model file. Implemented as a
+    generator which returns the colour tuple and colour name.
+    :param model_filename: binary model file written by compile_colours().
+    :return: tuple of colour and name.
+    """
+    red, green, blue, label_ids, labels = map_colours(model_filename)
+    for colour_and_id in zip(red, green, blue, label_ids):
+        yield colour_and_id[0:3], labels[colour_and_id[3]]
+
+
 def generate_colours(count=100):
     """
     Generate random colour RGB space.  Implemented as a generator that yields
@@ -75,27 +182,361 @@ def colour_distance(colour1, colour2):
 # print('\nColour distance: {}\n'.format(colour_distance((1, 1, 1), (4, 5, 6))))
 
 
-def nearest_neighbours(model_colours, num_neighbours):
+def _distance_squared(colour1, colour2):
+    """
+    Squared colour distance. Ordering by the squared distance is the same as
+    ordering by colour_distance(), but it avoids the square root in the inner
+    loops of the spatial indexes.
+    """
+    return math.dist(colour1, colour2) ** 2
+
+
+def _push_neighbour(heap, num_neighbours, distance, index):
+    """
+    Keep the num_neighbours closest candidates seen so far in a max-heap of
+    (-distance, -index) tuples. The heap root is the current worst candidate.
+    """
+    item = (-distance, -index)
+    if len(heap) < num_neighbours:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+class NeighbourIndex:
+    """
+    Base class for the neighbour search backends used by nearest_neighbours().
+    The index is built once from the model colours, i.e. the
+    ((r, g, b), colour_name) tuples returned by load_colours(). This base class
+    implements the brute force search which sorts the whole model for every
+    query; subclasses replace _search() with a spatial search.
+    """
+
+    # Maximum number of model colours stored in a leaf node of a tree index.
+    leaf_size = 16
+
+    def __init__(self, model_colours):
+        self.model = list(model_colours)
+
+    def query(self, target, num_neighbours):
+        """
+        Find the model colours closest to the target colour.
+        :param target: RGB colour tuple to query.
+        :param num_neighbours: number of neighbours to return.
+        :return: list of ((r, g, b), colour_name) tuples ordered by distance.
+        """
+        return [self.model[index]
+                for distance, index in self.query_indices(target,
+                                                          num_neighbours)]
+
+    def query_indices(self, target, num_neighbours, excluded=frozenset()):
+        """
+        Find the positions in the model of the colours closest to the target.
+        :param target: RGB colour tuple to query.
+        :param num_neighbours: number of neighbours to return.
+        :param excluded: set of model indices to leave out of the search.
+        :return: list of (squared distance, model index) tuples ordered by
+        distance.
+        """
+        if num_neighbours <= 0 or not self.model:
+            return []
+        heap = []
+        self._search(target, num_neighbours, heap, excluded)
+        return [(-distance, -index)
+                for distance, index in sorted(heap, reverse=True)]
+
+    def _search(self, target, num_neighbours, heap, excluded):
+        """
+        Fill the heap with the nearest neighbours of the target, skipping the
+        excluded model indices.
+        """
+        for index, (colour, name) in enumerate(self.model):
+            if index not in excluded:
+                _push_neighbour(heap, num_neighbours,
+                                _distance_squared(colour, target), index)
+
+    def _widest_axis(self, indices):
+        """Return the colour channel with the largest spread of values."""
+        colours = [self.model[i][0] for i in indices]
+        spreads = [max(channel) - min(channel) for channel in zip(*colours)]
+        return spreads.index(max(spreads))
+
+    def _split(self, indices):
+        """
+        Sort the indices along the widest channel and split them at the median.
+        :return: tuple of axis, split value, lower half and upper half.
+        """
+        axis = self._widest_axis(indices)
+        indices.sort(key=lambda i: self.model[i][0][axis])
+        median = len(indices) // 2
+        split = self.model[indices[median]][0][axis]
+        return axis, split, indices[:median], indices[median:]
+
+
+class KDTree(NeighbourIndex):
+    """
+    k-d tree neighbour index. Each internal node splits the colours at the
+    median of the channel with the widest spread, so a query only descends
+    into the branches that can still hold a closer colour.
+    """
+
+    def __init__(self, model_colours):
+        super(KDTree, self).__init__(model_colours)
+        # A leaf is a list of model indices; an internal node is a tuple of
+        # (axis, split value, lower subtree, upper subtree).
+        self.root = self._build(list(range(len(self.model))))
+
+    def _build(self, indices):
+        if len(indices) <= self.leaf_size:
+            return indices
+        axis, split, lower, upper = self._split(indices)
+        return axis, split, self._build(lower), self._build(upper)
+
+    def _search(self, target, num_neighbours, heap, excluded, node=None):
+        if node is None:
+            node = self.root
+        if isinstance(node, list):
+            for index in node:
+                if index not in excluded:
+                    _push_neighbour(
+                        heap, num_neighbours,
+                        _distance_squared(self.model[index][0], target), index)
+            return
+        axis, split, lower, upper = node
+        diff = target[axis] - split
+        near, far = (lower, upper) if diff < 0 else (upper, lower)
+        self._search(target, num_neighbours, heap, excluded, near)
+        # Only search the far side of the splitting plane if it could still
+        # contain a colour closer than the current worst neighbour.
+        if len(heap) < num_neighbours or diff * diff <= -heap[0][0]:
+            self._search(target, num_neighbours, heap, excluded, far)
+
+
+class BallTree(NeighbourIndex):
+    """
+    Ball tree neighbour index. Each node stores the centre and radius of a
+    sphere enclosing all of its colours, so whole subtrees are skipped when the
+    sphere is further away than the current worst neighbour.
+    """
+
+    def __init__(self, model_colours):
+        super(BallTree, self).__init__(model_colours)
+        # A node is a tuple of (centre, radius, children) where children is
+        # either a list of model indices (leaf) or a tuple of two subtrees.
+        self.root = self._build(list(range(len(self.model))))
+
+    def _build(self, indices):
+        if not indices:
+            return None
+        colours = [self.model[i][0] for i in indices]
+        centre = tuple(sum(channel) / len(colours) for channel in zip(*colours))
+        radius = max(colour_distance(centre, colour) for colour in colours)
+        if len(indices) <= self.leaf_size:
+            return centre, radius, indices
+        axis, split, lower, upper = self._split(indices)
+        return centre, radius, (self._build(lower), self._build(upper))
+
+    def _search(self, target, num_neighbours, heap, excluded, node=None):
+        if node is None:
+            node = self.root
+        centre, radius, children = node
+        # The heap holds squared distances, the ball bound is a real distance.
+        if len(heap) == num_neighbours and \
+                colour_distance(centre, target) - radius > \
+                math.sqrt(-heap[0][0]):
+            return
+        if isinstance(children, list):
+            for index in children:
+                if index not in excluded:
+                    _push_neighbour(
+                        heap, num_neighbours,
+                        _distance_squared(self.model[index][0], target), index)
+            return
+        # Visit the child whose centre is closest to the target first.
+        children = sorted(children,
+                          key=lambda child: _distance_squared(child[0], target))
+        for child in children:
+            self._search(target, num_neighbours, heap, excluded, child)
+
+
+class LiveModel:
+    """
+    Model that labelled colours can be added to and removed from while it is
+    being queried. New colours are kept in a small delta that is searched by
+    brute force and removed colours are marked with tombstones and skipped by
+    the index search, so an update does not rebuild the index. Once the delta
+    and tombstones grow past a fraction of the model, the index is rebuilt
+    (compacted) in a background thread and swapped in when ready.
+    """
+
+    def __init__(self, model_colours, index_type=KDTree, compaction_ratio=0.1,
+                 min_compaction=256):
+        """
+        Build the initial index over the model colours.
+        :param model_colours: ((r, g, b), colour_name) tuples, e.g. the output
+        of load_colours(). Their ids are their positions in this sequence.
+        :param index_type: NeighbourIndex subclass used to index the model.
+        :param compaction_ratio: compact once the number of pending changes is
+        this fraction of the indexed colours.
+        :param min_compaction: minimum number of pending changes to compact.
+        """
+        self.index_type = index_type
+        self.compaction_ratio = compaction_ratio
+        self.min_compaction = min_compaction
+        self.lock = threading.Lock()
+        model = list(model_colours)
+        self.index = index_type(model)
+        # Colour id of each position in the index. The ids are in increasing
+        # order, so the position of an id is found by binary search.
+        self.index_ids = list(range(len(model)))
+        self.live_ids = set(self.index_ids)
+        self.next_id = len(model)
+        # Colours added since the last compaction, by colour id.
+        self.delta = {}
+        # Ids of the colours removed since the last compaction, and the
+        # positions in the index of those that are in it.
+        self.tombstones = set()
+        self.removed_positions = set()
+        self.compactor = None
+
+    def __len__(self):
+        return len(self.live_ids)
+
+    def add(self, colour, name):
+        """
+        Add a labelled colour to the model.
+        :return: id of the new colour, used to remove it again.
+        """
+        with self.lock:
+            colour_id = self.next_id
+            self.next_id += 1
+            self.delta[colour_id] = (tuple(colour), name)
+            self.live_ids.add(colour_id)
+        self._check_compaction()
+        return colour_id
+
+    def remove(self, colour_id):
+        """
+        Remove a colour from the model.
+        :raise: KeyError if there is no colour with the given id.
+        """
+        with self.lock:
+            self.live_ids.remove(colour_id)
+            self.delta.pop(colour_id, None)
+            # The tombstone is needed even for a colour in the delta, because
+            # a compaction in progress may already be indexing it.
+            self.tombstones.add(colour_id)
+            position = self._index_position(colour_id)
+            if position is not None:
+                self.removed_positions.add(position)
+        self._check_compaction()
+
+    def _index_position(self, colour_id):
+        """Return the position of a colour id in the index, or None."""
+        position = bisect_left(self.index_ids, colour_id)
+        if position < len(self.index_ids) and \
+                self.index_ids[position] == colour_id:
+            return position
+        return None
+
+    def query(self, target, num_neighbours):
+        """
+        Find the model colours closest to the target colour.
+        :param target: RGB colour tuple to query.
+        :param num_neighbours: number of neighbours to return.
+        :return: list of ((r, g, b), colour_name) tuples ordered by distance.
+        """
+        with self.lock:
+            found = [
+                (distance, self.index.model[index])
+                for distance, index in self.index.query_indices(
+                    target, num_neighbours, self.removed_positions)
+            ]
+            found.extend((_distance_squared(item[0], target), item)
+                         for item in self.delta.values())
+        found.sort(key=lambda neighbour: neighbour[0])
+        return [item for distance, item in found[:num_neighbours]]
+
+    def compact(self, background=True):
+        """
+        Rebuild the index from the live colours, folding in the delta and
+        dropping the removed colours.
+        :param background: build the new index in a background thread, or
+        if False, wait until every change made before the call is folded in.
+        If a compaction is already running, it is used instead of starting
+        another one.
+        :return: None
+        """
+        with self.lock:
+            compactor = self.compactor
+            running = compactor is not None
+            if not running:
+                live = [(self.index_ids[i], item)
+                        for i, item in enumerate(self.index.model)
+                        if self.index_ids[i] not in self.tombstones]
+                live.extend(self.delta.items())
+                compactor = threading.Thread(
+                    target=self._rebuild,
+                    args=(live, set(self.delta), set(self.tombstones)),
+                    daemon=True)
+                self.compactor = compactor
+                compactor.start()
+        if not background:
+            compactor.join()
+            if running:
+                # The running compaction started before this call, so the
+                # changes made since then still have to be folded in.
+                self.compact(background=False)
+
+    def _check_compaction(self):
+        """Start a background compaction once enough changes are pending."""
+        pending = len(self.delta) + len(self.tombstones)
+        if self.compactor is None and pending >= max(
+                self.min_compaction,
+                self.compaction_ratio * len(self.index_ids)):
+            self.compact()
+
+    def _rebuild(self, live, folded_ids, dropped_ids):
+        """
+        Build a new index over the live colours and swap it in. Changes made
+        while the index is being built stay in the delta and tombstones.
+        """
+        index = self.index_type([item for colour_id, item in live])
+        with self.lock:
+            self.index = index
+            self.index_ids = [colour_id for colour_id, item in live]
+            for colour_id in folded_ids:
+                self.delta.pop(colour_id, None)
+            self.tombstones -= dropped_ids
+            # Colours removed while the index was being built may be in it.
+            self.removed_positions = {
+                position for position in map(self._index_position,
+                                             self.tombstones)
+                if position is not None}
+            self.compactor = None
+
+
+def nearest_neighbours(model_colours, num_neighbours, index_type=KDTree):
     """
     Coroutine used to implement the k-nearest neighbour calculation.
-    :param model_colours: list of colours to be used as a model.
+    :param model_colours: list of colours to be used as a model, or a
+    LiveModel that can be updated while the coroutine is running.
     :param num_neighbours: number of neighbours to query.
+    :param index_type: NeighbourIndex subclass used to search the model; the
+    index is built once when the coroutine is started.
     :return:
     """
-    model = list(model_colours)
+    if isinstance(model_colours, LiveModel):
+        index = model_colours
+    else:
+        index = index_type(model_colours)
     # Accept a tuple of colour values.
     target = yield
     while True:
-        # New list sorted by distance in ascending order.
-        distances = sorted(
-            ((colour_distance(c[0], target), c) for c in model),
-        )
         # Yield the target's k-nearest neighbours in the model, i.e. yield the
         # ((r, g, b), colour_name) tuple for the k values with the lowest
         # distance.
-        target = yield [
-            d[1] for d in distances[0:num_neighbours]
-        ]
+        target = yield index.query(target, num_neighbours)
 
 
 # Test the code so far.
@@ -125,6 +566,24 @@ def write_results(filename='output.csv'):
             writer.writerow(list(colour) + [name])
 
 
+def write_result_batches(filename='output.csv', buffer_size=1 << 20):
+    """
+    Batched equivalent of write_results(). Implemented as a coroutine that
+    accepts (colours, names) tuples of equal length sequences, and writes each
+    chunk with a single writerows() call through a large output buffer. The
+    coroutine must be closed to flush the buffer.
+    :param filename: output CSV file name.
+    :param buffer_size: size in bytes of the output buffer.
+    :return:
+    """
+    with open(filename, 'w', buffering=buffer_size) as file:
+        writer = csv.writer(file)
+        while True:
+            colours, names = yield
+            writer.writerows([*colour, name]
+                             for colour, name in zip(colours, names))
+
+
 # Test write_results() coroutine.
 # results = write_results()
 # next(results)
@@ -148,31 +607,197 @@ def name_colours(get_neighbours):
         colour = yield name_guess
 
 
-def process_colours(dataset_filename='colors.csv'):
+def model_digest(dataset_filename):
+    """Return the SHA-256 digest of a model file, used to detect changes."""
+    digest = hashlib.sha256()
+    with open(dataset_filename, 'rb') as dataset_file:
+        for block in iter(lambda: dataset_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def write_colour_table(table_filename, label_ids, labels, digest,
+                       num_neighbours):
+    """
+    Write a colour lookup table file.
+    :param table_filename: output lookup table file.
+    :param label_ids: TABLE_SIZE bytes, the label id of every colour.
+    :param labels: list of label names indexed by label id.
+    :param digest: model_digest() of the model the table was built from.
+    :param num_neighbours: number of neighbours used to build the table.
+    :return: None
+    """
+    if len(label_ids) != TABLE_SIZE:
+        raise ValueError("A colour table must hold {} label ids".format(
+            TABLE_SIZE))
+    table = '\n'.join(labels).encode('utf8')
+    with open(table_filename, 'wb') as table_file:
+        table_file.write(_table_header.pack(TABLE_MAGIC, digest,
+                                            num_neighbours, len(table)))
+        table_file.write(table)
+        table_file.write(label_ids)
+
+
+class ColourTable:
+    """
+    Lookup table holding the name of every colour with 8 bits per channel, so
+    naming a colour is a single index into the memory mapped table.
+    """
+
+    def __init__(self, table_filename):
+        """
+        Memory map a lookup table file written by write_colour_table().
+        :param table_filename: lookup table file.
+        """
+        with open(table_filename, 'rb') as table_file:
+            data = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest, self.num_neighbours, table_size = \
+            _table_header.unpack_from(data)
+        if magic != TABLE_MAGIC:
+            raise ValueError("Not a colour lookup table")
+        offset = _table_header.size
+        self.labels = data[offset:offset + table_size].decode('utf8').split(
+            '\n')
+        offset += table_size
+        self.label_ids = memoryview(data)[offset:offset + TABLE_SIZE]
+
+    def is_stale(self, dataset_filename, num_neighbours=5):
+        """
+        Check whether the table was built from a different model file or
+        number of neighbours and has to be rebuilt.
+        """
+        return (self.num_neighbours != num_neighbours or
+                self.digest != model_digest(dataset_filename))
+
+    def name(self, colour):
+        """Return the name of an RGB colour with channels from 0 to 1."""
+        red, green, blue = (min(max(int(round(c * 255)), 0), 255)
+                            for c in colour)
+        return self.labels[self.label_ids[red << 16 | green << 8 | blue]]
+
+
+def table_names(table):
+    """
+    Drop-in replacement for the name_colours() coroutine that names colours
+    from a ColourTable instead of searching the model.
+    :param table: ColourTable to serve the names from.
+    :return: The colour name.
+    """
+    colour = yield
+    while True:
+        colour = yield table.name(colour)
+
+
+class PredictionCache:
+    """
+    Bounded least recently used cache of colour names. Colours are quantised
+    to a number of bits per channel, so every colour that falls in the same
+    quantisation bin shares one cache entry.
+    """
+
+    def __init__(self, bits=8, max_size=65536):
+        """
+        Create an empty cache.
+        :param bits: number of bits per RGB channel used to quantise colours.
+        :param max_size: maximum number of names held in the cache.
+        """
+        self.bits = bits
+        self.max_size = max_size
+        self.levels = (1 << bits) - 1
+        self.names = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, colour):
+        """Quantise an RGB colour, with channels from 0 to 1, to a cache key."""
+        return tuple(min(max(int(round(c * self.levels)), 0), self.levels)
+                     for c in colour)
+
+    def colour(self, key):
+        """Return the colour at the centre of the bin of a cache key."""
+        return tuple(c / self.levels for c in key)
+
+    def get(self, key):
+        """Return the cached name for the key, or None if it is not cached."""
+        try:
+            name = self.names[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.names.move_to_end(key)
+        self.hits += 1
+        return name
+
+    def put(self, key, name):
+        """Cache the name for the key, evicting the least recently used."""
+        self.names[key] = name
+        self.names.move_to_end(key)
+        if len(self.names) > self.max_size:
+            self.names.popitem(last=False)
+
+
+def cached_names(get_colour_name, cache):
+    """
+    Memoise the names returned from the name_colours() coroutine. On a cache
+    miss the quantised colour is named, so the answer for a colour does not
+    depend on which colour in its bin was seen first.
+    :param get_colour_name: instance of the name_colours() coroutine.
+    :param cache: PredictionCache holding the names and hit/miss counters.
+    :return: The colour name.
+    """
+    colour = yield
+    while True:
+        key = cache.key(colour)
+        name = cache.get(key)
+        if name is None:
+            name = get_colour_name.send(cache.colour(key))
+            cache.put(key, name)
+        colour = yield name
+
+
+def process_colours(dataset_filename='colors.csv', index_type=KDTree,
+                    cache=None, table=None, count=100,
+                    output_filename='output.csv'):
     """
     Initiate the colour processing using the training data set file.
     :param dataset_filename: training data set file of colours.
+    :param index_type: neighbour search backend; NeighbourIndex (brute force),
+    KDTree or BallTree.
+    :param cache: optional PredictionCache used to memoise colour names.
+    :param table: optional ColourTable to serve the names from instead of the
+    training data set.
+    :param count: number of random colours to name.
+    :param output_filename: output CSV file name.
     :return: None
     """
-    # Object used to load the training data set into the model
-    model_colours = load_colours(dataset_filename)
-    # Object used to calculate the k-nearest neighbours
-    get_neighbours = nearest_neighbours(model_colours, 5)
-    # Object used to get the most common colour name from the nearest neighbours
-    get_colour_name = name_colours(get_neighbours)
+    if table is not None:
+        # The lookup table already holds the name of every colour
+        get_colour_name = table_names(table)
+    else:
+        # Object used to load the training data set into the model
+        model_colours = load_colours(dataset_filename)
+        # Object used to calculate the k-nearest neighbours
+        get_neighbours = nearest_neighbours(model_colours, 5, index_type)
+        next(get_neighbours)
+        # Object used to get the most common colour name from the nearest
+        # neighbours
+        get_colour_name = name_colours(get_neighbours)
     # Object used to write the results out to the output file
-    output = write_results()
+    output = write_results(output_filename)
     # Advance all coroutines to their first yield
     next(output)
-    next(get_neighbours)
     next(get_colour_name)
+    if cache is not None:
+        get_colour_name = cached_names(get_colour_name, cache)
+        next(get_colour_name)
 
     # Generate random colours and get their names
-    for colour in generate_colours():
+    for colour in generate_colours(count):
         # Get the name of the colour corresponding to the random colour
         name = get_colour_name.send(colour)
         # Write the output to file
         output.send((colour, name))
+    output.close()
 
 
 if __name__ == '__main__':
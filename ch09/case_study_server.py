@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import functools
+
+from case_study_batch import BatchClassifier, load_model_arrays
+
+# Network front end for the k-nearest neighbour colour classifier. Clients
+# connect over TCP and send one colour per line as three channel values from 0
+# to 1 separated by commas or spaces, e.g. "0.2,0.4,0.9". The server answers
+# each line, in order, with the colour name or with "ERROR <reason>".
+#
+# Queries from all connections are collected for a few milliseconds and named
+# together with one vectorised call to the BatchClassifier, so the throughput
+# is that of batch classification while each query waits at most one batch
+# interval plus the time to classify the batch before it. The classification
+# runs in a worker thread, so the event loop keeps serving connections while a
+# batch is being named.
+
+# Default time in seconds that queries are collected before being named.
+DEFAULT_INTERVAL = 0.002
+
+# Default maximum number of queries named in one batch.
+DEFAULT_MAX_BATCH = 4096
+
+# Maximum number of unanswered queries per connection before the server stops
+# reading from that connection.
+MAX_PENDING = 10000
+
+
+def parse_colour(line):
+    """
+    Parse a query line into an RGB colour tuple.
+    :param line: three channel values separated by commas or whitespace.
+    :return: tuple of three floats.
+    :raise: ValueError if the line is not a valid colour.
+    """
+    values = line.replace(',', ' ').split()
+    if len(values) != 3:
+        raise ValueError("expected 3 channel values, got {}".format(
+            len(values)))
+    return tuple(float(value) for value in values)
+
+
+class MicroBatcher:
+    """
+    Collects the colours submitted by concurrent clients and names them in
+    batches, either when the batch interval expires or the batch is full.
+    One batch at a time is named in an executor; colours submitted meanwhile
+    are named in the next batch as soon as it finishes.
+    """
+
+    def __init__(self, classifier, interval=DEFAULT_INTERVAL,
+                 max_batch=DEFAULT_MAX_BATCH, executor=None):
+        """
+        :param classifier: BatchClassifier used to name the colours.
+        :param interval: time in seconds that colours are collected for.
+        :param max_batch: maximum number of colours named in one batch.
+        :param executor: concurrent.futures executor the batches are named
+        in; defaults to the event loop's default thread pool.
+        """
+        self.classifier = classifier
+        self.interval = interval
+        self.max_batch = max_batch
+        self.executor = executor
+        self.pending = []
+        self.flush_handle = None
+        # True while a batch is being named in the executor.
+        self.busy = False
+
+    def submit(self, colour):
+        """
+        Queue a colour to be named in the next batch.
+        :param colour: RGB colour tuple.
+        :return: future for the colour name.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((colour, future))
+        # While a batch is being named, the queued colours wait for it.
+        if self.busy:
+            pass
+        elif len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.interval, self.flush)
+        return future
+
+    def flush(self):
+        """
+        Start naming up to max_batch of the queued colours in the executor,
+        unless a batch is already being named.
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.busy or not self.pending:
+            return
+        batch = self.pending[:self.max_batch]
+        del self.pending[:self.max_batch]
+        self.busy = True
+        loop = asyncio.get_running_loop()
+        names = loop.run_in_executor(self.executor, self.classifier.classify,
+                                     [colour for colour, future in batch])
+        names.add_done_callback(functools.partial(self._resolve, batch))
+
+    def _resolve(self, batch, names):
+        """
+        Resolve the futures of a named batch, then start on the colours that
+        were queued while it was being named.
+        """
+        self.busy = False
+        try:
+            names = names.result()
+        except Exception as e:
+            for colour, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (colour, future), name in zip(batch, names):
+                # The future is cancelled if its client has gone away.
+                if not future.done():
+                    future.set_result(name)
+        self.flush()
+
+
+class ColourServer:
+    """Line based TCP server answering colour name queries."""
+
+    def __init__(self, classifier, interval=DEFAULT_INTERVAL,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.batcher = MicroBatcher(classifier, interval, max_batch)
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """
+        Start listening for clients.
+        :return: the asyncio Server; use port 0 to pick a free port.
+        """
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    async def handle_client(self, reader, writer):
+        """
+        Read the queries from one client. Each query is submitted straight
+        away and its future is queued, so the client can pipeline queries
+        while the answers are sent back in order by _send_answers(). Once the
+        client has finished sending, the remaining answers are sent before
+        the connection is closed, unless the client has gone away.
+        """
+        loop = asyncio.get_running_loop()
+        answers = asyncio.Queue(MAX_PENDING)
+        sender = asyncio.ensure_future(self._send_answers(answers, writer))
+        try:
+            while not sender.done():
+                try:
+                    line = await reader.readline()
+                except ConnectionError:
+                    break
+                if not line:
+                    # Wait for the answers to be sent, or for the sender to
+                    # stop because the client has gone away.
+                    sent = asyncio.ensure_future(answers.join())
+                    await asyncio.wait({sent, sender},
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    sent.cancel()
+                    break
+                line = line.decode('utf8', 'replace').strip()
+                if not line:
+                    continue
+                try:
+                    future = self.batcher.submit(parse_colour(line))
+                except ValueError as e:
+                    future = loop.create_future()
+                    future.set_result("ERROR {}".format(e))
+                if answers.full():
+                    # Stop reading until there is room, or the sender stops.
+                    put = asyncio.ensure_future(answers.put(future))
+                    await asyncio.wait({put, sender},
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not put.done():
+                        put.cancel()
+                        future.cancel()
+                        break
+                else:
+                    answers.put_nowait(future)
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            # Stop waiting for the names of the unanswered queries.
+            while not answers.empty():
+                answers.get_nowait().cancel()
+            writer.close()
+
+    async def _send_answers(self, answers, writer):
+        """
+        Write the answers to the client in the order of the queries, until
+        the connection is closed.
+        """
+        while True:
+            future = await answers.get()
+            try:
+                answer = await future
+            except Exception as e:
+                answer = "ERROR {}".format(e)
+            if writer.is_closing():
+                return
+            writer.write((answer + '\n').encode('utf8'))
+            # Only wait for the socket once the answers ready so far have been
+            # written, so a burst of answers is sent with few writes.
+            if answers.empty():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    return
+            answers.task_done()
+
+
+async def serve(dataset_filename='colors.csv', host='127.0.0.1', port=8765,
+                interval=DEFAULT_INTERVAL, max_batch=DEFAULT_MAX_BATCH):
+    """
+    Load the model and serve colour name queries until cancelled.
+    :param dataset_filename: training data set file of colours or compiled
+    model file.
+    :param host: address to listen on.
+    :param port: port to listen on.
+    :param interval: time in seconds that queries are collected for.
+    :param max_batch: maximum number of queries named in one batch.
+    :return: None
+    """
+    classifier = BatchClassifier(*load_model_arrays(dataset_filename))
+    server = await ColourServer(classifier, interval, max_batch).start(host,
+                                                                       port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve colour name queries over TCP.')
+    parser.add_argument('--dataset', default='colors.csv',
+                        help='training data set file of colours or compiled '
+                             'model file')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port to listen on')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='seconds that queries are collected for')
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help='maximum number of queries named in one batch')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.dataset, args.host, args.port, args.interval,
+                          args.max_batch))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()